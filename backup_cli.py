@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+import json
+import sys
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from temporalio.client import Client
+
+from control_plane import DEFAULT_ID_REUSE, DEFAULT_ON_CONFLICT, ID_REUSE, ON_CONFLICT, BackupControl, trigger_backup, workflow_id_for_folders
+from file_backup_activities import BLOB_DIR, connect_client
+from host_registry import resolve_hosts
+
+
+# Jobs started, queried or signalled at once
+DEFAULT_CONCURRENCY = 8
+
+
+# A jobs file is JSON:
+# {
+#   "defaults": {"options": {"io_mode": "cache_neutral", "auto_approve": true}},
+#   "jobs": [
+#     {"name": "photos", "sources": ["/data/photos"], "destinations": ["/backup/a", "/backup/b"]},
+#     {"name": "home", "sources": ["/home/me"], "destinations": ["/backup/a"], "options": {"rate_limits": {"bytes_per_second": 50000000}}}
+#   ]
+# }
+# Job options are the workflow's run options, they override the defaults key by key. A job can also
+# set "on_conflict" and "id_reuse" (see control_plane), the command line gives the defaults. Two jobs
+# can't back up the same folders to the same destinations, they would share one workflow.
+def load_jobs(path: str, names: Optional[List[str]] = None) -> List[dict]:
+    with open(path) as f:
+        config = json.load(f)
+    default_options = config.get("defaults", {}).get("options", {})
+    jobs = []
+    seen = set()
+    workflow_ids = {}
+    for job in config["jobs"]:
+        for key in ("name", "sources", "destinations"):
+            if not job.get(key):
+                raise ValueError(f"Job {job.get('name', '?')} has no {key}")
+        if job.get("on_conflict", DEFAULT_ON_CONFLICT) not in ON_CONFLICT or job.get("id_reuse", DEFAULT_ID_REUSE) not in ID_REUSE:
+            raise ValueError(f"Job {job['name']} has an unknown on_conflict or id_reuse policy")
+        if job["name"] in seen:
+            raise ValueError(f"Job {job['name']} is defined twice")
+        seen.add(job["name"])
+        workflow_id = workflow_id_for(job)
+        if workflow_id in workflow_ids:
+            raise ValueError(f"Jobs {workflow_ids[workflow_id]} and {job['name']} back up the same folders")
+        workflow_ids[workflow_id] = job["name"]
+        if names and job["name"] not in names:
+            continue
+        jobs.append(dict(job, options={**default_options, **job.get("options", {})}))
+    missing = set(names or []) - seen
+    if missing:
+        raise ValueError(f"Unknown jobs: {', '.join(sorted(missing))}")
+    return jobs
+
+
+def workflow_id_for(job: dict) -> str:
+    # Keyed by the folders like the workflows started by file_backup3, so both trigger the same workflow
+    return workflow_id_for_folders(job["sources"], job["destinations"])
+
+
+def emit(record: dict):
+    # One JSON object per line on stdout, whatever else is logged goes to stderr
+    print(json.dumps(record, default=str), flush=True)
+
+
+async def start_job(client: Client, job: dict, wait: bool, on_conflict: str, id_reuse: str, by: str = "backup_cli") -> dict:
+    # A job already running gets the trigger instead (by default), the reported run is the one serving it
+    workflow_id = workflow_id_for(job)
+    options = dict(job["options"])
+    folder_hosts = resolve_hosts(job["sources"], blob_dir=BLOB_DIR)
+    if folder_hosts:
+        options["folder_hosts"] = folder_hosts
+    trigger = {"by": by, "requested_at": datetime.now(timezone.utc).isoformat()}
+    handle = await trigger_backup(client, workflow_id, job["sources"], job["destinations"], options, trigger,
+                                  job.get("on_conflict", on_conflict), job.get("id_reuse", id_reuse))
+    record = {"job": job["name"], "workflow_id": workflow_id, "run_id": handle.result_run_id, "status": "triggered"}
+    if wait:
+        record.update(status="completed", summary=await handle.result())
+    return record
+
+
+# Commands on running jobs, pause and resume are acknowledged by the workflows through updates
+COMMANDS = ("status", "pause", "resume", "cancel")
+
+
+async def run_bounded(calls: list, concurrency: int) -> bool:
+    # Runs (key, coroutine function) pairs at most `concurrency` at a time, emitting each result as it
+    # arrives. Returns False if any of them failed.
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(key: dict, call):
+        async with semaphore:
+            try:
+                emit({**key, "ok": True, **await call()})
+                return True
+            except Exception as e:
+                emit({**key, "ok": False, "error": f"{type(e).__name__}: {e}"})
+                return False
+
+    return all(await asyncio.gather(*[run(key, call) for key, call in calls]))
+
+
+async def run_command(args) -> bool:
+    # The jobs file is checked before connecting, every call then shares the one client
+    if args.command == "start":
+        jobs = load_jobs(args.jobs, args.job)
+        calls = [({"job": job["name"]}, lambda job=job: start_job(client, job, args.wait, args.on_conflict, args.id_reuse)) for job in jobs]
+    else:
+        targets = list(args.workflow_ids)
+        if args.jobs:
+            targets += [workflow_id_for(job) for job in load_jobs(args.jobs, args.job)]
+        if args.all:
+            targets.append("all")
+        targets += [f"host:{host}" for host in args.host or []]
+        if not targets:
+            raise SystemExit("Give workflow ids, --jobs, --all or --host")
+    client = await connect_client()
+    if args.command == "start":
+        return await run_bounded(calls, args.concurrency)
+    control = BackupControl(client, args.concurrency)
+    results = await control.run(args.command, await control.resolve(targets))
+    for workflow_id, result in results.items():
+        emit({"workflow_id": workflow_id, "ok": result["ok"], **(result["ack"] if result["ok"] else {"error": result["error"]})})
+    return all(result["ok"] for result in results.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start and control file backup jobs, results are printed as JSON lines")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="jobs handled at once")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    start = subparsers.add_parser("start", help="start the jobs of a jobs file")
+    start.add_argument("--jobs", required=True, help="jobs file")
+    start.add_argument("--job", nargs="+", help="only these jobs")
+    start.add_argument("--wait", action="store_true", help="wait for the jobs to finish and print their summaries")
+    start.add_argument("--on-conflict", choices=ON_CONFLICT, default=DEFAULT_ON_CONFLICT,
+                       help="what a trigger does to a job that is already running")
+    start.add_argument("--id-reuse", choices=ID_REUSE, default=DEFAULT_ID_REUSE,
+                       help="when a trigger may start a new run of a job that ran before")
+
+    for command in COMMANDS:
+        targets = subparsers.add_parser(command, help=f"{command} running jobs")
+        targets.add_argument("workflow_ids", nargs="*", help="workflow ids")
+        targets.add_argument("--jobs", help="also every job of this jobs file")
+        targets.add_argument("--job", nargs="+", help="only these jobs of the jobs file")
+        targets.add_argument("--all", action="store_true", help="also every running job")
+        targets.add_argument("--host", nargs="+", help="also every running job with folders on these hosts")
+
+    args = parser.parse_args()
+    try:
+        ok = asyncio.run(run_command(args))
+    except Exception as e:
+        # Bad jobs file or no connection, nothing was done
+        emit({"ok": False, "error": f"{type(e).__name__}: {e}"})
+        ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
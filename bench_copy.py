@@ -0,0 +1,153 @@
+import argparse
+import asyncio
+import ctypes
+import ctypes.util
+import mmap
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import List
+
+from copy_engine import IO_MODES, READ_ORDERS, copy_file, fadvise, plan_read_order
+
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+libc.mmap.restype = ctypes.c_void_p
+libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+
+
+def resident_pages(path: str) -> int:
+    # Count the pages of a file that are in the page cache, using mincore on a mapping of it
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0
+    pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        address = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if address in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), "mmap failed")
+        try:
+            vector = (ctypes.c_ubyte * pages)()
+            if libc.mincore(address, size, vector) != 0:
+                raise OSError(ctypes.get_errno(), "mincore failed")
+            return sum(byte & 1 for byte in vector)
+        finally:
+            libc.munmap(address, size)
+    finally:
+        os.close(fd)
+
+
+def residency_mb(paths: List[str]) -> float:
+    return sum(resident_pages(path) for path in paths) * mmap.PAGESIZE / 1024 / 1024
+
+
+def drop_from_cache(paths: List[str]):
+    for path in paths:
+        with open(path, "rb") as f:
+            fadvise(f.fileno(), 0, 0, "POSIX_FADV_DONTNEED")
+
+
+def make_files(folder: str, count: int, size: int) -> List[str]:
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f"file_{i}.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+            f.flush()
+            os.fsync(f.fileno())
+        paths.append(path)
+    return paths
+
+
+async def bench_page_cache(args):
+    work = tempfile.mkdtemp(dir=args.dir)
+    try:
+        sources = make_files(os.path.join(work, "source"), args.files, args.size_mb * 1024 * 1024)
+        total_mb = args.files * args.size_mb
+        print(f"{args.files} files, {total_mb} MB per run")
+        print(f"{'mode':<14}{'seconds':>9}{'src before':>12}{'src after':>11}{'dst after':>11}   (MB resident)")
+        for io_mode in IO_MODES:
+            drop_from_cache(sources)
+            backups = [os.path.join(work, io_mode, os.path.basename(path)) for path in sources]
+            before = residency_mb(sources)
+            started = time.perf_counter()
+            for source, backup in zip(sources, backups):
+                await copy_file(source, backup, io_mode=io_mode, direct_io_min_bytes=0)
+            elapsed = time.perf_counter() - started
+            print(f"{io_mode:<14}{elapsed:>9.2f}{before:>12.1f}{residency_mb(sources):>11.1f}{residency_mb(backups):>11.1f}")
+    finally:
+        shutil.rmtree(work)
+
+
+def make_fragmented_tree(folder: str, count: int, size: int, chunk: int) -> List[str]:
+    # Files get random names so walk order is unrelated to disk layout, and are grown
+    # round robin with a sync per round so their extents interleave on disk
+    os.makedirs(folder, exist_ok=True)
+    names = [f"file_{i:05d}.bin" for i in random.sample(range(count), count)]
+    handles = [open(os.path.join(folder, name), "wb") for name in names]
+    try:
+        for _ in range(size // chunk):
+            for f in handles:
+                f.write(os.urandom(chunk))
+                f.flush()
+                os.fsync(f.fileno())
+    finally:
+        for f in handles:
+            f.close()
+    return [os.path.join(root, name) for root, _, files in os.walk(folder) for name in files]
+
+
+async def bench_read_order(args):
+    work = tempfile.mkdtemp(dir=args.dir)
+    try:
+        sources = make_fragmented_tree(os.path.join(work, "source"), args.files, args.size_kb * 1024, args.chunk_kb * 1024)
+        print(f"{args.files} files of {args.size_kb} KB written in {args.chunk_kb} KB interleaved chunks")
+        print(f"{'order':<8}{'plan s':>8}{'read s':>8}{'speedup':>9}")
+        baseline = None
+        for read_order in READ_ORDERS:
+            drop_from_cache(sources)
+            started = time.perf_counter()
+            planned = plan_read_order([(path,) for path in sources], read_order)
+            planning = time.perf_counter() - started
+            # Only the reads are timed, the page cache is dropped before each order
+            drop_from_cache(sources)
+            started = time.perf_counter()
+            for (path,) in planned:
+                with open(path, "rb") as f:
+                    while f.read(1024 * 1024):
+                        pass
+            elapsed = time.perf_counter() - started
+            baseline = baseline or elapsed
+            print(f"{read_order:<8}{planning:>8.2f}{elapsed:>8.2f}{baseline / elapsed:>8.2f}x")
+    finally:
+        shutil.rmtree(work)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy engine benchmarks")
+    parser.add_argument("--dir", default=None, help="directory to create scratch files in")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    page_cache = subparsers.add_parser("page-cache", help="page cache residency of each io mode")
+    page_cache.add_argument("--files", type=int, default=8)
+    page_cache.add_argument("--size-mb", type=int, default=64)
+    page_cache.set_defaults(run=bench_page_cache)
+
+    read_order = subparsers.add_parser("read-order", help="read time of a fragmented tree in each read order")
+    read_order.add_argument("--files", type=int, default=200)
+    read_order.add_argument("--size-kb", type=int, default=1024)
+    read_order.add_argument("--chunk-kb", type=int, default=64)
+    read_order.set_defaults(run=bench_read_order)
+
+    args = parser.parse_args()
+    asyncio.run(args.run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import json
+from datetime import timedelta
+from typing import Dict, List, Optional, Union
+
+from temporalio.client import Client, WorkflowExecutionStatus, WorkflowHandle
+from temporalio.common import WorkflowIDConflictPolicy, WorkflowIDReusePolicy
+
+from file_backup_workflow import TASK_QUEUE, FileBackupWorkflow
+
+
+# Workflows a batch command talks to at once
+DEFAULT_CONCURRENCY = 8
+
+WORKFLOW_ID_PREFIX = "file-backup-"
+
+# What a trigger does while the job's workflow is running: "coalesce" folds it into one follow-up
+# incremental pass, "replace" terminates the running pass and starts over, "reject" fails the trigger
+ON_CONFLICT = {
+    "coalesce": WorkflowIDConflictPolicy.USE_EXISTING,
+    "replace": WorkflowIDConflictPolicy.TERMINATE_EXISTING,
+    "reject": WorkflowIDConflictPolicy.FAIL,
+}
+DEFAULT_ON_CONFLICT = "coalesce"
+
+# Whether a trigger may start a new run once the last one closed: "always", "after_failure" (only if
+# the last run failed, was cancelled or terminated) or "never"
+ID_REUSE = {
+    "always": WorkflowIDReusePolicy.ALLOW_DUPLICATE,
+    "after_failure": WorkflowIDReusePolicy.ALLOW_DUPLICATE_FAILED_ONLY,
+    "never": WorkflowIDReusePolicy.REJECT_DUPLICATE,
+}
+DEFAULT_ID_REUSE = "always"
+
+# Top level backup runs, child FolderBackupWorkflows get their commands from their parent
+RUNNING_BACKUPS_QUERY = "WorkflowType = 'FileBackupWorkflow' AND ExecutionStatus = 'Running'"
+
+CONSOLE_PROMPT = ("Enter 'pause', 'resume', 'status', 'approve <folder|all>', 'reject <folder|all>', "
+                  "'throttle <setting>=<value> ...', 'cancel' or 'terminate', optionally followed by targets "
+                  "(@all, @host:<name>, @<workflow id>), or 'q' to quit: ")
+
+
+def workflow_id_for_folders(source_folders: List[str], backup_folder: Union[str, List[str]]) -> str:
+    # The same folders always map to the same workflow, so triggers for them meet in one workflow id
+    backup_folders = [backup_folder] if isinstance(backup_folder, str) else list(backup_folder)
+    key = json.dumps([sorted(source_folders), sorted(backup_folders)])
+    return f"{WORKFLOW_ID_PREFIX}{hashlib.sha1(key.encode()).hexdigest()[:16]}"
+
+
+async def trigger_backup(client: Client, workflow_id: str, source_folders: List[str], backup_folder: Union[str, List[str]],
+                         options: dict, trigger: Optional[dict] = None, on_conflict: str = DEFAULT_ON_CONFLICT,
+                         id_reuse: str = DEFAULT_ID_REUSE) -> WorkflowHandle:
+    # Starts the job's workflow, or hands the trigger to the run already going. Signal-with-start does
+    # both in one call, so two triggers can never both start a run.
+    if on_conflict not in ON_CONFLICT or id_reuse not in ID_REUSE:
+        raise ValueError(f"Unknown conflict or reuse policy {on_conflict!r}, {id_reuse!r}")
+    start_options = dict(
+        args=[source_folders, backup_folder, workflow_id, options],
+        id=workflow_id,
+        task_queue=TASK_QUEUE,
+        task_timeout=timedelta(seconds=30),
+        id_reuse_policy=ID_REUSE[id_reuse],
+        id_conflict_policy=ON_CONFLICT[on_conflict],
+    )
+    if on_conflict == "reject":
+        # Signal-with-start always lands somewhere, a plain start is what fails on a running workflow
+        return await client.start_workflow(FileBackupWorkflow.run, **start_options)
+    return await client.start_workflow(FileBackupWorkflow.run, start_signal="request_backup",
+                                       start_signal_args=[trigger or {}], **start_options)
+
+
+class BackupControl:
+    # Commands to many backup workflows over one client. Pause, resume, approvals and throttling go
+    # through workflow updates, so every target acknowledges with the state it is in afterwards.
+    def __init__(self, client: Client, concurrency: int = DEFAULT_CONCURRENCY):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def running_backups(self) -> List[str]:
+        return [execution.id async for execution in self.client.list_workflows(RUNNING_BACKUPS_QUERY)]
+
+    async def hosts_of(self, workflow_id: str) -> List[str]:
+        async with self.semaphore:
+            return await self.client.get_workflow_handle(workflow_id).query(FileBackupWorkflow.get_hosts)
+
+    async def resolve(self, targets: List[str]) -> List[str]:
+        # "all" is every running backup, "host:<name>" every running backup with a folder on that host,
+        # anything else a workflow id
+        workflow_ids = []
+        running = None
+        for target in targets:
+            if target == "all" or target.startswith("host:"):
+                running = running if running is not None else await self.running_backups()
+                if target == "all":
+                    workflow_ids += running
+                else:
+                    hosts = await asyncio.gather(*[self.hosts_of(workflow_id) for workflow_id in running], return_exceptions=True)
+                    workflow_ids += [workflow_id for workflow_id, owners in zip(running, hosts)
+                                     if not isinstance(owners, Exception) and target[len("host:"):] in owners]
+            else:
+                workflow_ids.append(target)
+        return list(dict.fromkeys(workflow_ids))
+
+    async def pause(self, workflow_id: str) -> dict:
+        return await self.client.get_workflow_handle(workflow_id).execute_update(FileBackupWorkflow.set_paused, True)
+
+    async def resume(self, workflow_id: str) -> dict:
+        return await self.client.get_workflow_handle(workflow_id).execute_update(FileBackupWorkflow.set_paused, False)
+
+    async def review(self, workflow_id: str, decisions: dict) -> dict:
+        pending = await self.client.get_workflow_handle(workflow_id).execute_update(FileBackupWorkflow.review_folders, decisions)
+        return {"pending_approvals": pending}
+
+    async def throttle(self, workflow_id: str, throttle: dict) -> dict:
+        return await self.client.get_workflow_handle(workflow_id).execute_update(FileBackupWorkflow.update_throttle, throttle)
+
+    async def cancel(self, workflow_id: str) -> dict:
+        await self.client.get_workflow_handle(workflow_id).cancel()
+        return {"status": "cancel requested"}
+
+    async def terminate(self, workflow_id: str) -> dict:
+        await self.client.get_workflow_handle(workflow_id).terminate(reason="User requested termination")
+        return {"status": "terminated"}
+
+    async def status(self, workflow_id: str) -> dict:
+        handle = self.client.get_workflow_handle(workflow_id)
+        description = await handle.describe()
+        record = {"run_id": description.run_id, "status": description.status.name,
+                  "started": description.start_time, "closed": description.close_time}
+        if description.status == WorkflowExecutionStatus.RUNNING:
+            record["paused"] = await handle.query(FileBackupWorkflow.is_paused)
+            record["folder_progress"] = await handle.query(FileBackupWorkflow.get_folder_progress)
+            record["pending_approvals"] = await handle.query(FileBackupWorkflow.pending_approvals)
+            record["destination_status"] = await handle.query(FileBackupWorkflow.destination_status)
+            record["triggers"] = await handle.query(FileBackupWorkflow.get_triggers)
+        elif description.status == WorkflowExecutionStatus.COMPLETED:
+            record["summary"] = await handle.result()
+        return record
+
+    async def run(self, command: str, workflow_ids: List[str], *args) -> Dict[str, dict]:
+        # Sends one command to every workflow, {workflow_id: {"ok": True, "ack": ...} or {"ok": False, "error": ...}}
+        method = getattr(self, command)
+
+        async def send(workflow_id: str) -> dict:
+            async with self.semaphore:
+                try:
+                    return {"ok": True, "ack": await method(workflow_id, *args)}
+                except Exception as e:
+                    return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+        results = await asyncio.gather(*[send(workflow_id) for workflow_id in workflow_ids])
+        return dict(zip(workflow_ids, results))
+
+
+def parse_command(line: str):
+    # "<command> [arguments] [@target ...]" -> (command, arguments, targets)
+    words = line.split()
+    targets = [word[1:] for word in words if word.startswith("@")]
+    words = [word for word in words if not word.startswith("@")]
+    if not words:
+        return None, [], targets
+    command, arguments = words[0].lower(), words[1:]
+    if command in ("approve", "reject"):
+        # e.g. approve /data/photos /data/music, approve all
+        folders = ["*" if folder == "all" else folder for folder in arguments] or ["*"]
+        return "review", [{folder: command == "approve" for folder in folders}], targets
+    if command == "throttle":
+        # e.g. throttle bytes_per_second=20000000 batch_window=2 max_concurrent_copies=none
+        throttle = {
+            key: None if value.lower() == "none" else float(value)
+            for key, _, value in (setting.partition("=") for setting in arguments)
+        }
+        return "throttle", [throttle], targets
+    return command, arguments, targets
+
+
+async def console(control: BackupControl, default_targets: List[str]):
+    # Reads commands without blocking the event loop, every command runs on the one client and loop.
+    # A closed stdin (nohup, systemd) ends the console like "q", the backups keep running.
+    while True:
+        try:
+            line = (await asyncio.to_thread(input, CONSOLE_PROMPT)).strip()
+        except EOFError:
+            print("No console input, the console is closed")
+            break
+        if line.lower() == "q":
+            break
+        try:
+            command, arguments, targets = parse_command(line)
+        except ValueError as e:
+            print(f"Invalid input: {e}")
+            continue
+        if command not in ("pause", "resume", "status", "review", "throttle", "cancel", "terminate"):
+            print("Invalid input. Please try again.")
+            continue
+        workflow_ids = await control.resolve(targets or default_targets)
+        if not workflow_ids:
+            print("No matching workflows")
+            continue
+        for workflow_id, result in (await control.run(command, workflow_ids, *arguments)).items():
+            print(f"{workflow_id}: {result['ack'] if result['ok'] else result['error']}")
@@ -0,0 +1,548 @@
+import asyncio
+import errno
+import hashlib
+import mmap
+import os
+import struct
+import time
+from concurrent.futures import Executor, as_completed
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Size of each read/write when copying a file
+CHUNK_SIZE = 1024 * 1024
+
+# In cache neutral mode, written data is flushed and dropped from the page cache this often
+CACHE_NEUTRAL_FLUSH_BYTES = 8 * CHUNK_SIZE
+
+# Chunks buffered per destination when fanning out, and how long a full destination may hold the reader back
+FANOUT_QUEUE_CHUNKS = 8
+FANOUT_STALL_SECONDS = 60
+
+# Files at least this big are read with O_DIRECT in "direct" io mode
+DIRECT_IO_MIN_BYTES = 256 * CHUNK_SIZE
+
+# io modes: "buffered" (plain reads/writes), "cache_neutral" (fadvise) and "direct" (O_DIRECT reads for large files)
+IO_MODES = ("buffered", "cache_neutral", "direct")
+
+# Read orders: "walk" (os.walk order), "inode" (inode number) and "extent" (first physical extent via FIEMAP, falling back to inode)
+READ_ORDERS = ("walk", "inode", "extent")
+
+# ioctl number and struct layout from linux/fiemap.h, asking for a single extent
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+
+# Parallel copies split files into pieces of this size, each copied and hashed on its own thread.
+# The file digest is the sha256 of the size and the piece digests, so it is the same whatever the thread count.
+TREE_HASH_CHUNK_BYTES = 64 * CHUNK_SIZE
+
+# Parallel copies write next to the backup file under this suffix and only move it into place once every
+# piece is written. A copy killed midway leaves no full size backup with holes for the next scan to trust.
+PARTIAL_SUFFIX = ".file-backup-partial"
+
+
+# Async token bucket, a rate of None or 0 means unlimited
+class TokenBucket:
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None):
+        self.lock = asyncio.Lock()
+        self.changed = asyncio.Event()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate: Optional[float], burst: Optional[float] = None):
+        self.rate = rate or None
+        # Allow one second worth of burst unless told otherwise
+        self.capacity = burst or self.rate or 0
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        # Wake every waiter so the new rate applies right away
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self, amount: float = 1):
+        # The lock only covers the bookkeeping, waiting happens outside it so other waiters and
+        # rate changes never queue behind a sleeping acquirer
+        while self.rate:
+            async with self.lock:
+                self.refill()
+                # Requests larger than the bucket wait for a full bucket and go into debt instead of waiting forever
+                needed = min(amount, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+                changed = self.changed
+            try:
+                await asyncio.wait_for(changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+# Bytes and files per second budget shared by every copy of a job, and the files per second of its scans
+class CopyLimiter:
+    def __init__(self, limits: Optional[dict] = None):
+        self.bytes = TokenBucket()
+        self.files = TokenBucket()
+        self.scan_files = TokenBucket()
+        self.limits = {}
+        self.configure(limits or {})
+
+    def configure(self, limits: dict):
+        limits = {
+            "bytes_per_second": limits.get("bytes_per_second"),
+            "files_per_second": limits.get("files_per_second"),
+            "scan_files_per_second": limits.get("scan_files_per_second"),
+        }
+        if limits == self.limits:
+            return
+        self.limits = limits
+        self.bytes.set_rate(limits["bytes_per_second"])
+        self.files.set_rate(limits["files_per_second"])
+        self.scan_files.set_rate(limits["scan_files_per_second"])
+
+
+# One limiter per job, shared by all concurrent copy and scan activities of the job in this worker
+# process. A limiter lives as long as one of them is running, then it is dropped.
+_limiters: Dict[str, CopyLimiter] = {}
+_limiter_users: Dict[str, int] = {}
+
+
+def acquire_limiter(job_id: str, limits: Optional[dict] = None) -> CopyLimiter:
+    # Every acquire_limiter is paired with a release_limiter once the activity is done
+    limiter = _limiters.get(job_id)
+    if limiter is None:
+        limiter = _limiters[job_id] = CopyLimiter(limits)
+    elif limits is not None:
+        limiter.configure(limits)
+    _limiter_users[job_id] = _limiter_users.get(job_id, 0) + 1
+    return limiter
+
+
+def release_limiter(job_id: str):
+    _limiter_users[job_id] -= 1
+    if not _limiter_users[job_id]:
+        del _limiter_users[job_id]
+        del _limiters[job_id]
+
+
+def first_physical_offset(path: str) -> Optional[int]:
+    if fcntl is None:
+        return None
+    request = bytearray(FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT.size))
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request, True)
+    except OSError:
+        # Not Linux, or a filesystem without FIEMAP support
+        return None
+    finally:
+        os.close(fd)
+    mapped_extents = FIEMAP_HEADER.unpack_from(request)[3]
+    if not mapped_extents:
+        # Empty or inline files have no extent to seek to
+        return None
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+
+def read_order_key(path: str, read_order: str) -> tuple:
+    if read_order == "extent":
+        physical = first_physical_offset(path)
+        if physical is not None:
+            return (0, physical)
+    try:
+        return (1, os.stat(path).st_ino)
+    except OSError:
+        return (2, 0)
+
+
+def plan_read_order(files: Sequence[Sequence], read_order: str = "walk") -> List:
+    # Reorder (source_file, ...) entries so sources are read in on-disk order, cutting seeks on spinning disks
+    if read_order == "walk":
+        return list(files)
+    keys = {entry[0]: read_order_key(entry[0], read_order) for entry in files}
+    return sorted(files, key=lambda entry: keys[entry[0]])
+
+
+def chunk_size_for(limiter: Optional[CopyLimiter]) -> int:
+    # Keep each throttled wait to a fraction of a second so heartbeats keep flowing
+    if limiter and limiter.bytes.rate:
+        return int(max(64 * 1024, min(CHUNK_SIZE, limiter.bytes.rate / 4)))
+    return CHUNK_SIZE
+
+
+def fadvise(fd: int, offset: int, length: int, advice_name: str):
+    # posix_fadvise is a hint, missing on some platforms (macOS) and allowed to fail
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+
+def open_direct(source_file: str) -> Optional[int]:
+    if not hasattr(os, "O_DIRECT"):
+        return None
+    try:
+        return os.open(source_file, os.O_RDONLY | os.O_DIRECT)
+    except OSError:
+        # e.g. tmpfs and some network filesystems refuse O_DIRECT
+        return None
+
+
+def read_direct(fd: int, buffer: mmap.mmap) -> bytes:
+    # O_DIRECT needs an aligned buffer and length, anonymous mmap memory is page aligned
+    read = os.readv(fd, [buffer])
+    return buffer[:read]
+
+
+class CopyInterrupted(Exception):
+    # Raised when should_stop ends a copy early. Everything before offset is written to every backup
+    # file not in failures, the copy can be resumed from there.
+    def __init__(self, offset: int, failures: Optional[Dict[str, Exception]] = None):
+        super().__init__(f"Copy interrupted at byte {offset}")
+        self.offset = offset
+        self.failures = failures or {}
+
+
+class SourceReader:
+    def __init__(self, source_file: str, limiter: Optional[CopyLimiter] = None, io_mode: str = "buffered",
+                 direct_io_min_bytes: int = DIRECT_IO_MIN_BYTES, offset: int = 0):
+        self.limiter = limiter
+        self.cache_neutral = io_mode in ("cache_neutral", "direct")
+        self.file = open(source_file, "rb")
+        self.file.seek(offset)
+        self.offset = offset
+        self.direct_fd = None
+        self.buffer = None
+        # O_DIRECT reads have to start on a page boundary
+        if io_mode == "direct" and os.fstat(self.file.fileno()).st_size >= direct_io_min_bytes and offset % mmap.PAGESIZE == 0:
+            self.direct_fd = open_direct(source_file)
+        if self.direct_fd is not None:
+            os.lseek(self.direct_fd, offset, os.SEEK_SET)
+            self.buffer = mmap.mmap(-1, max(mmap.PAGESIZE, chunk_size_for(limiter) // mmap.PAGESIZE * mmap.PAGESIZE))
+        if self.cache_neutral:
+            fadvise(self.file.fileno(), 0, 0, "POSIX_FADV_SEQUENTIAL")
+
+    async def read(self) -> bytes:
+        # The read runs in a thread, the event loop keeps serving the worker's other copies and heartbeats
+        chunk = await asyncio.to_thread(self.read_chunk)
+        if chunk and self.limiter:
+            await self.limiter.bytes.acquire(len(chunk))
+        return chunk
+
+    def read_chunk(self) -> bytes:
+        if self.direct_fd is not None:
+            chunk = read_direct(self.direct_fd, self.buffer)
+        else:
+            chunk = self.file.read(chunk_size_for(self.limiter))
+        if self.cache_neutral:
+            # Source pages are clean and can be dropped right away
+            fadvise(self.file.fileno(), self.offset, len(chunk), "POSIX_FADV_DONTNEED")
+        self.offset += len(chunk)
+        return chunk
+
+    def close(self):
+        try:
+            if self.cache_neutral:
+                # Also drop whatever readahead pulled in past the last chunk
+                fadvise(self.file.fileno(), 0, 0, "POSIX_FADV_DONTNEED")
+            if self.direct_fd is not None:
+                os.close(self.direct_fd)
+                self.buffer.close()
+        finally:
+            self.file.close()
+
+
+# Blocking, copies run its methods in a thread
+class BackupWriter:
+    def __init__(self, backup_file: str, cache_neutral: bool = False, offset: int = 0):
+        os.makedirs(os.path.dirname(backup_file), exist_ok=True)
+        if offset:
+            # Resuming: keep what was written before offset, drop anything after it
+            self.file = open(backup_file, "r+b")
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        else:
+            self.file = open(backup_file, "wb")
+        self.cache_neutral = cache_neutral
+        self.written = offset
+        self.dropped = offset
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+        self.written += len(chunk)
+        if self.cache_neutral and self.written - self.dropped >= CACHE_NEUTRAL_FLUSH_BYTES:
+            self.drop_written()
+
+    def drop_written(self):
+        # Dirty pages are only dropped once written back
+        self.file.flush()
+        os.fdatasync(self.file.fileno())
+        fadvise(self.file.fileno(), self.dropped, self.written - self.dropped, "POSIX_FADV_DONTNEED")
+        self.dropped = self.written
+
+    def close(self):
+        try:
+            if self.cache_neutral and not self.file.closed:
+                self.drop_written()
+        finally:
+            self.file.close()
+
+
+async def copy_file(source_file: str, backup_file: str, limiter: Optional[CopyLimiter] = None, on_chunk: Optional[Callable[[int], None]] = None,
+                    io_mode: str = "buffered", direct_io_min_bytes: int = DIRECT_IO_MIN_BYTES, offset: int = 0,
+                    should_stop: Optional[Callable[[], bool]] = None):
+    # Copies from offset on (0 for the whole file). Once should_stop returns True the copy stops
+    # between chunks and raises CopyInterrupted. on_chunk gets the offset the backup is written up to,
+    # a copy cut off later can be resumed from there.
+    if limiter:
+        await limiter.files.acquire()
+    # Open the source first so a vanished source never truncates an existing backup.
+    # Opening, writing and closing (an fdatasync in cache neutral mode) all happen in threads.
+    reader = await asyncio.to_thread(SourceReader, source_file, limiter, io_mode, direct_io_min_bytes, offset)
+    interrupted = False
+    try:
+        writer = await asyncio.to_thread(BackupWriter, backup_file, reader.cache_neutral, offset)
+        try:
+            while True:
+                if should_stop and should_stop():
+                    interrupted = True
+                    break
+                chunk = await reader.read()
+                if not chunk:
+                    break
+                await asyncio.to_thread(writer.write, chunk)
+                if on_chunk:
+                    on_chunk(writer.written)
+        finally:
+            await asyncio.to_thread(writer.close)
+    finally:
+        await asyncio.to_thread(reader.close)
+    if interrupted:
+        raise CopyInterrupted(reader.offset)
+
+
+async def drain_to(writer: BackupWriter, queue: asyncio.Queue):
+    # Writes run in threads so destinations on separate volumes proceed in parallel
+    error = None
+    try:
+        while chunk := await queue.get():
+            # After a write error keep draining so the reader is never blocked by this destination
+            if error is None:
+                try:
+                    await asyncio.to_thread(writer.write, chunk)
+                except Exception as e:
+                    error = e
+    except asyncio.CancelledError:
+        # A write may still be stuck in its thread, close the file from the executor once it returns
+        asyncio.get_running_loop().run_in_executor(None, writer.close)
+        raise
+    await asyncio.to_thread(writer.close)
+    if error:
+        raise error
+
+
+async def copy_file_to_many(source_file: str, backup_files: List[str], limiter: Optional[CopyLimiter] = None,
+                            on_chunk: Optional[Callable[[int], None]] = None, io_mode: str = "buffered",
+                            direct_io_min_bytes: int = DIRECT_IO_MIN_BYTES, stall_seconds: float = FANOUT_STALL_SECONDS,
+                            offset: int = 0, should_stop: Optional[Callable[[], bool]] = None) -> Dict[str, Exception]:
+    # Reads each source chunk once and tees it to every backup file, returning the failures per backup file.
+    # offset and should_stop work as in copy_file, CopyInterrupted carries the failures so far.
+    if len(backup_files) == 1:
+        try:
+            await copy_file(source_file, backup_files[0], limiter, on_chunk, io_mode, direct_io_min_bytes, offset, should_stop)
+            return {}
+        except CopyInterrupted:
+            raise
+        except Exception as e:
+            return {backup_files[0]: e}
+
+    if limiter:
+        await limiter.files.acquire()
+    try:
+        reader = await asyncio.to_thread(SourceReader, source_file, limiter, io_mode, direct_io_min_bytes, offset)
+    except Exception as e:
+        return {backup_file: e for backup_file in backup_files}
+
+    failures = {}
+    queues = {}
+    writers = {}
+    backups = {}
+    interrupted = False
+    try:
+        for backup_file in backup_files:
+            try:
+                writer = await asyncio.to_thread(BackupWriter, backup_file, reader.cache_neutral, offset)
+            except Exception as e:
+                failures[backup_file] = e
+                continue
+            backups[backup_file] = writer
+            # The bounded queue is the backpressure, a full queue holds the reader back
+            queues[backup_file] = asyncio.Queue(FANOUT_QUEUE_CHUNKS)
+            writers[backup_file] = asyncio.create_task(drain_to(writer, queues[backup_file]))
+
+        while queues:
+            if should_stop and should_stop():
+                # An empty chunk ends every writer as if the source had ended here
+                interrupted = True
+                chunk = b""
+            else:
+                try:
+                    chunk = await reader.read()
+                except Exception as e:
+                    failures.update({backup_file: e for backup_file in queues})
+                    for backup_file in queues:
+                        writers[backup_file].cancel()
+                    break
+            for backup_file, queue in list(queues.items()):
+                try:
+                    await asyncio.wait_for(queue.put(chunk), stall_seconds)
+                except asyncio.TimeoutError:
+                    # Give up on a destination that stays full, the others carry on
+                    failures[backup_file] = TimeoutError(errno.ETIMEDOUT, f"Backup destination stalled for {stall_seconds}s", backup_file)
+                    writers[backup_file].cancel()
+                    del queues[backup_file]
+            if not chunk:
+                break
+            if on_chunk and queues:
+                # Writers lag behind the reader by up to a queue's worth, only what all of them wrote counts
+                on_chunk(min(backups[backup_file].written for backup_file in queues))
+
+        for backup_file, task in writers.items():
+            if backup_file in failures:
+                continue
+            try:
+                await task
+            except Exception as e:
+                failures[backup_file] = e
+    finally:
+        await asyncio.to_thread(reader.close)
+    if interrupted:
+        raise CopyInterrupted(reader.offset, failures)
+    return failures
+
+
+def write_all(fd: int, data: bytes, offset: int):
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+
+def copy_range(source_fd: int, backup_fds: Dict[str, int], offset: int, length: int, failures: Dict[str, Exception]) -> bytes:
+    # Copies one piece to every destination that hasn't failed yet and returns the piece's digest.
+    # pread, pwrite and sha256 all release the GIL, so pieces really run in parallel on threads.
+    digest = hashlib.sha256()
+    end = offset + length
+    while offset < end:
+        data = os.pread(source_fd, min(CHUNK_SIZE, end - offset), offset)
+        if not data:
+            raise OSError(errno.EIO, "File shrank while being read")
+        digest.update(data)
+        for backup_file, fd in backup_fds.items():
+            if backup_file not in failures:
+                try:
+                    write_all(fd, data, offset)
+                except Exception as e:
+                    failures[backup_file] = e
+        offset += len(data)
+    return digest.digest()
+
+
+def piece_ranges(size: int, chunk_bytes: int) -> List[Tuple[int, int]]:
+    return [(offset, min(chunk_bytes, size - offset)) for offset in range(0, size, chunk_bytes)]
+
+
+def tree_digest(size: int, piece_digests: List[bytes]) -> str:
+    root = hashlib.sha256(size.to_bytes(8, "big"))
+    for piece_digest in piece_digests:
+        root.update(piece_digest)
+    return root.hexdigest()
+
+
+def run_pieces(pool: Executor, ranges: List[Tuple[int, int]], piece: Callable[[int, int], bytes],
+               on_chunk: Optional[Callable[[], None]] = None) -> List[bytes]:
+    # on_chunk runs on the calling thread, activity heartbeats only work there
+    futures = {pool.submit(piece, offset, length): index for index, (offset, length) in enumerate(ranges)}
+    digests = [b""] * len(ranges)
+    for future in as_completed(futures):
+        digests[futures[future]] = future.result()
+        if on_chunk:
+            on_chunk()
+    return digests
+
+
+def tree_hash(path: str, pool: Executor, chunk_bytes: int = TREE_HASH_CHUNK_BYTES,
+              on_chunk: Optional[Callable[[], None]] = None) -> str:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        return tree_digest(size, run_pieces(pool, piece_ranges(size, chunk_bytes), lambda offset, length: copy_range(fd, {}, offset, length, {}), on_chunk))
+    finally:
+        os.close(fd)
+
+
+def remove_partial(backup_file: str):
+    try:
+        os.remove(backup_file + PARTIAL_SUFFIX)
+    except OSError:
+        pass
+
+
+def copy_file_parallel(source_file: str, backup_files: List[str], pool: Executor, chunk_bytes: int = TREE_HASH_CHUNK_BYTES,
+                       on_chunk: Optional[Callable[[], None]] = None) -> Tuple[Optional[str], Dict[str, Exception]]:
+    # Blocking copy for process pool activities: the source is read once, piece by piece on the pool's threads,
+    # and written to every backup file. Returns the source's tree digest and the failures per backup file.
+    try:
+        source_fd = os.open(source_file, os.O_RDONLY)
+    except Exception as e:
+        return None, {backup_file: e for backup_file in backup_files}
+    failures = {}
+    backup_fds = {}
+    digest = None
+    try:
+        size = os.fstat(source_fd).st_size
+        for backup_file in backup_files:
+            try:
+                os.makedirs(os.path.dirname(backup_file), exist_ok=True)
+                fd = os.open(backup_file + PARTIAL_SUFFIX, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                backup_fds[backup_file] = fd
+                # Sized up front so pieces can be written in any order
+                os.ftruncate(fd, size)
+            except Exception as e:
+                failures[backup_file] = e
+        try:
+            digest = tree_digest(size, run_pieces(
+                pool, piece_ranges(size, chunk_bytes),
+                lambda offset, length: copy_range(source_fd, backup_fds, offset, length, failures), on_chunk))
+        except Exception as e:
+            failures.update({backup_file: e for backup_file in backup_files if backup_file not in failures})
+    finally:
+        for fd in backup_fds.values():
+            os.close(fd)
+        os.close(source_fd)
+    for backup_file in backup_fds:
+        if backup_file not in failures:
+            try:
+                os.replace(backup_file + PARTIAL_SUFFIX, backup_file)
+                continue
+            except Exception as e:
+                failures[backup_file] = e
+        remove_partial(backup_file)
+    return digest, failures
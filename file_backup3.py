@@ -1,18 +1,30 @@
+import argparse
 import asyncio
-import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import AsyncExitStack
 from datetime import timedelta
-from typing import List, Tuple
+from typing import List, Optional
 import logging
-from temporalio import workflow
 from temporalio.client import Client
-from temporalio.worker import Worker
-from temporalio import activity
-from temporalio.common import RetryPolicy
+from temporalio.worker import SharedStateManager, Worker
 from temporalio.client import WorkflowFailureError
-from temporalio.exceptions import CancelledError
-import threading
-import uuid
-from temporalio.exceptions import ApplicationError
+from file_backup_activities import (
+    BLOB_DIR,
+    CORES_PER_WORKER,
+    WorkerMetricsInterceptor,
+    connect_client,
+    copy_files_activity,
+    copy_files_sync_activity,
+    list_files_activity,
+    retry_failed_files_activity,
+    verify_files_activity,
+)
+from backup_cli import load_jobs, start_job
+from control_plane import DEFAULT_ID_REUSE, DEFAULT_ON_CONFLICT, BackupControl, console
+from file_backup_workflow import COPY_TASK_QUEUE, SCAN_TASK_QUEUE, TASK_QUEUE, VERIFY_TASK_QUEUE, FileBackupWorkflow, FolderBackupWorkflow
+from worker_tuning import MAX_COPY_SLOTS, build_tuner
+from host_registry import host_name, host_task_queue, register_host
 # from temporalio.client import Client
 
 
@@ -34,278 +46,137 @@ logging.getLogger("temporal_sdk_core").setLevel(logging.CRITICAL)
 logging.getLogger("temporal_sdk_core::worker::activities").setLevel(logging.CRITICAL)
 logging.getLogger("temporal_sdk_core::worker::activities").setLevel(logging.ERROR)
 
-def cancel_workflow(handle,workflow_id):
-    asyncio.run(handle.cancel())
-    # print(f"Cancellation requested for workflow with ID: {workflow_id}")
-       
-    
-
-
-def terminate_workflow(handle, workflow_id):
-    asyncio.run(handle.terminate(reason="User requested termination"))
-    # print("Workflow termination requested.")
-
-
-def manage_workflow(handle, workflow_id):
-    while True:
-        action = input("Enter 'pause', 'resume', 'terminate', or 'q' to quit: ").lower()
-        if action == 'pause':
-            asyncio.run(handle.signal(FileBackupWorkflow.pause_backup))
-            # print(f"Pause signal sent to workflow {workflow_id}")
-
-        elif action == 'resume':
-            asyncio.run(handle.signal(FileBackupWorkflow.resume_backup))
-            # print(f"Resume signal sent to workflow {workflow_id}")
-
-        elif action == 'terminate':
-            asyncio.run(handle.terminate(reason="User requested termination"))
-            # print(f"Termination requested for workflow {workflow_id}")
-            # break
-
-        elif action == 'q':
-            # print("Exiting without terminating the workflow.")
-            break
-        else:
-            print("Invalid input. Please try again.")
-    
-
-
-
-@activity.defn
-async def skip_task(source_folder: str):
-    pass
-    # activity.logger.info(f"No files to update in source folder: {source_folder}")
-
-@activity.defn
-async def list_files_activity(source_folder: str, backup_folder: str) -> List[Tuple[str, str]]:
-    files_to_update = []
-
-    if not os.path.exists(source_folder):
-        logger.error(f"Source folder '{source_folder}' does not exist.")
-        raise Exception(f"Source folder '{source_folder}' does not exist.")
-    
-    # if source_folder == "/Users/aasthathorat/temporal-project/source1":
-    #     raise ApplicationError("Intentionally failing this activity")
-
-    try:
-        # logger.info(f"Checking files in source folder: {source_folder}")
-        for root, _, files in os.walk(source_folder):
-            for file in files:
-                source_file = os.path.join(root, file)
-                relative_path = os.path.relpath(source_file, source_folder)
-                backup_file = os.path.join(backup_folder, relative_path)
-
-                source_mtime = os.path.getmtime(source_file)
-                if os.path.exists(backup_file):
-                    backup_mtime = os.path.getmtime(backup_file)
-                    if source_mtime > backup_mtime:
-                        files_to_update.append((source_file, backup_file))
-                else:
-                    files_to_update.append((source_file, backup_file))
-    
-
-        # logger.info(f"Found {len(files_to_update)} files to update in {source_folder}")
-        return files_to_update
-
-    except Exception as e:
-        error_message = f"Error during file listing for folder '{source_folder}': {e}"
-        # logger.error(error_message)
-        raise
-
-
-
-
-@activity.defn
-async def copy_files_activity(files_to_update: List[Tuple[str, str]], source_folder: str, workflow_id: str):
-    # print(f"Inside copy files for {source_folder}")
-    client = await Client.connect("localhost:7233")
-    files_copied = 0
-    # print(source_folder)
-    for source_file, backup_file in files_to_update:
-        try:
-            os.makedirs(os.path.dirname(backup_file), exist_ok=True)
-            with open(source_file, "rb") as src, open(backup_file, "wb") as dst:
-                dst.write(src.read())
-            files_copied += 1
-            # print(f"files copied -> {files_copied}")
-            activity.heartbeat()
-
-            handle = client.get_workflow_handle(workflow_id)
-
-            # # Query the workflow
-
-            is_paused = await handle.query(FileBackupWorkflow.is_paused)
-            # print("is paused ",is_paused)
-
-            if is_paused:
-                return "PAUSE",files_copied
-
-            # if files_copied == pause_after and pause_after == 50:
-            #     return "PAUSE"
-        except Exception as e:
-            pass
-            # print(e)
-    
-    return "SUCCESS", files_copied
-
-
-@activity.defn
-async def get_user_input(task_name: str) -> str:
-    while True:
-        status = input(f"{task_name} completed. Enter 'success' or 'failure': ").lower()
-        if status in ['success', 'failure']:
-            return status
-        # print("Invalid input. Please enter 'success' or 'failure'.")
-
-
-
-@workflow.defn
-class FileBackupWorkflow:
-    def __init__(self):
-        self.files_copied = {}
-        self.folders_to_process = []
-    
-    @workflow.run
-    async def run(self, source_folders: List[str], backup_folder: str, workflow_id: str):
-        print("Starting file backup workflow with parallel list and copy files.")
-        
-        # Execute list_files_activity for all folders in parallel
-        list_tasks = [
-            workflow.execute_activity(
-                list_files_activity,
-                args=[folder, backup_folder],
-                start_to_close_timeout=timedelta(minutes=5),
-                retry_policy=RetryPolicy(maximum_attempts=3),
-            )
-            for folder in source_folders
-        ]
-        files_to_update_list = await asyncio.gather(*list_tasks)
-        
-        # Ask for user input for each folder's list files result
-        for folder, files_to_update in zip(source_folders, files_to_update_list):
-            status = await workflow.execute_activity(
-                get_user_input,
-                args=[f"List Files for folder {folder}"],
-                start_to_close_timeout=timedelta(minutes=5),
-            )
-            if status == "success":
-                self.folders_to_process.append((folder, files_to_update))
-            else:
-                print(f"List files task for {folder} marked as failure. Skipping folder.")
-        
-        # Process approved folders in parallel
-        copy_tasks = [
-            self.process_folder(folder, files_to_update, backup_folder, workflow_id)
-            for folder, files_to_update in self.folders_to_process
-        ]
-        await asyncio.gather(*copy_tasks)
-
-    async def process_folder(self, source_folder: str, files_to_update: List[str], backup_folder: str, workflow_id: str):
-        if len(files_to_update) > 0:
-            # Ask for user input before copying
-            status = await workflow.execute_activity(
-                get_user_input,
-                args=[f"Proceed with copying files for {source_folder}"],
-                start_to_close_timeout=timedelta(minutes=5),
-            )
-
-            if status == "failure":
-                print(f"Copy files task for {source_folder} marked as failure. Skipping folder.")
-                return
-
-            # Only copy files if user marked as success
-            result, files_copied = await workflow.execute_activity(
-                copy_files_activity,
-                args=[files_to_update, source_folder, workflow_id],
-                start_to_close_timeout=timedelta(minutes=10),
-                heartbeat_timeout=timedelta(seconds=1),
-            )
-
-            self.files_copied[source_folder] = files_copied
-            if result == "PAUSE":
-                self.paused = True
-                await workflow.wait_condition(lambda: not self.paused)
-
-            # Copy remaining files if any
-            if len(files_to_update) > self.files_copied[source_folder]:
-                result = await workflow.execute_activity(
-                    copy_files_activity,
-                    args=[files_to_update[self.files_copied[source_folder]:], source_folder, workflow_id],
-                    start_to_close_timeout=timedelta(minutes=30),
-                    heartbeat_timeout=timedelta(seconds=30),
-                )
-                self.files_copied[source_folder] = len(files_to_update)
-
-            print(f"Finished processing all {self.files_copied[source_folder]} files from {source_folder}")
-        else:
-            print(f"No files to update in {source_folder}")
+# How long a stopping worker waits for running activities before cancelling them. Copies notice the
+# shutdown within a chunk, heartbeat a checkpoint and fail over, so this is only a safety net.
+WORKER_DRAIN_TIMEOUT = timedelta(seconds=60)
+
+# Processes running blocking copy and verify activities, one pool per worker process
+COPY_PROCESSES = CORES_PER_WORKER
+
+# One Worker per pool. max_concurrent_activities caps the pool's activities per worker process,
+# max_activities_per_second (None for no limit) throttles how fast it starts them.
+WORKER_POOLS = {
+    "control": {"task_queue": TASK_QUEUE},
+    "scan": {"task_queue": SCAN_TASK_QUEUE, "max_concurrent_activities": 16, "max_activities_per_second": None},
+    "copy": {"task_queue": COPY_TASK_QUEUE, "max_concurrent_activities": MAX_COPY_SLOTS, "max_activities_per_second": None},
+    "verify": {"task_queue": VERIFY_TASK_QUEUE, "max_concurrent_activities": COPY_PROCESSES, "max_activities_per_second": None},
+}
+
+
+_shared_state_manager = None
+_process_pool = None
+
+
+def shared_state_manager() -> SharedStateManager:
+    # Heartbeats of process pool activities reach the worker through this, one manager process for all pools
+    global _shared_state_manager
+    if _shared_state_manager is None:
+        _shared_state_manager = SharedStateManager.create_from_multiprocessing(multiprocessing.Manager())
+    return _shared_state_manager
+
+
+def process_pool() -> ProcessPoolExecutor:
+    # The copy and verify pools share it. spawn, the Temporal runtime's threads don't survive a fork
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(COPY_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+
+def build_worker(client: Client, pool: str, host: Optional[str] = None) -> Worker:
+    # With a host, activity pools poll that host's queues and only get work for folders the host owns
+    config = WORKER_POOLS[pool]
+    options = dict(task_queue=config["task_queue"], graceful_shutdown_timeout=WORKER_DRAIN_TIMEOUT)
+    if pool == "control":
+        # Local activities run on the worker of their workflow, so the fast path activities are registered
+        # here. Only as local activities, regular ones go to the scan and copy pools.
+        return Worker(
+            client,
+            workflows=[FileBackupWorkflow, FolderBackupWorkflow],
+            activities=[list_files_activity, copy_files_activity],
+            no_remote_activities=True,
+            # Slots follow CPU and memory load instead of fixed counts
+            tuner=build_tuner("resources"),
+            **options,
+        )
+    options["task_queue"] = host_task_queue(config["task_queue"], host)
+    options["max_activities_per_second"] = config["max_activities_per_second"]
+    if pool == "scan":
+        # The tuners replace max_concurrent_activities in the scan and copy pools and cap their slots at it instead
+        return Worker(client, activities=[list_files_activity], tuner=build_tuner("resources", config["max_concurrent_activities"]), **options)
+    if pool == "copy":
+        return Worker(
+            client,
+            activities=[copy_files_activity, retry_failed_files_activity, copy_files_sync_activity],
+            activity_executor=process_pool(),
+            shared_state_manager=shared_state_manager(),
+            interceptors=[WorkerMetricsInterceptor()],
+            tuner=build_tuner("disk", config["max_concurrent_activities"]),
+            **options,
+        )
+    return Worker(
+        client,
+        activities=[verify_files_activity],
+        activity_executor=process_pool(),
+        shared_state_manager=shared_state_manager(),
+        interceptors=[WorkerMetricsInterceptor()],
+        max_concurrent_activities=config["max_concurrent_activities"],
+        **options,
+    )
 
-    
-    @workflow.signal
-    def pause_backup(self):
-        print("Received signal to pause backup")
-        self.paused = True
 
-    @workflow.signal
-    def resume_backup(self):
-        print("Received signal to resume backup")
-        self.paused = False
+async def start_workers(stack: AsyncExitStack, client: Client, pools: Optional[List[str]] = None, host: Optional[str] = None):
+    for pool in pools or WORKER_POOLS:
+        await stack.enter_async_context(build_worker(client, pool, host))
 
 
+async def run_worker(stop: asyncio.Event, pools: Optional[List[str]] = None, roots: Optional[List[str]] = None):
+    # Worker only entry point, used by worker_supervisor. Runs the given pools (all by default) until
+    # stop is set, then stops polling. Running copies checkpoint and hand over to another worker,
+    # anything else gets WORKER_DRAIN_TIMEOUT to finish.
+    # With roots, the host registers them as its own and serves the folders under them.
+    host = None
+    if roots:
+        host = host_name()
+        register_host(host, roots, blob_dir=BLOB_DIR)
+    client = await connect_client()
+    async with AsyncExitStack() as stack:
+        await start_workers(stack, client, pools, host)
+        await stop.wait()
 
 
-# main method
 async def main():
-    client = await Client.connect("localhost:7233")
-    print("A connection to the Temporal server is established")
-    
-    source_folders = [
-        "/Users/aasthathorat/temporal-project/source1",
-        # "/Users/aasthathorat/temporal-project/source4",
-         "/Users/aasthathorat/temporal-project/source2",
-         "/Users/aasthathorat/temporal-project/source3",
-         "/Users/aasthathorat/temporal-project/source6"
-
-    ]
-    backup_folder = "/Users/aasthathorat/temporal-project/backup2"
-
-   
+    parser = argparse.ArgumentParser(description="Run the workers, back up the jobs of a jobs file and control them from a console")
+    parser.add_argument("--jobs", required=True, help="jobs file, see backup_cli")
+    parser.add_argument("--job", nargs="+", help="only these jobs")
+    args = parser.parse_args()
+    jobs = load_jobs(args.jobs, args.job)
 
-    worker = Worker(
-        client,
-        task_queue="file-backup-task-queue",
-        workflows=[FileBackupWorkflow],
-        activities=[list_files_activity, copy_files_activity , skip_task, get_user_input],
-    )
-
-    async with worker:
-        workflow_id = f"file-backup-{uuid.uuid4()}"
-        # workflow_id = "file_backup_workflow-2"
-        handle = await client.start_workflow(
-            FileBackupWorkflow.run,
-            args=[source_folders, backup_folder, workflow_id],
-            id=workflow_id,
-            task_queue="file-backup-task-queue",
-            task_timeout=timedelta(seconds=30) 
-        )
-        
-        print(f"Workflow started with ID: {workflow_id}")
+    client = await connect_client()
+    print("A connection to the Temporal server is established")
 
-        # Start the termination input thread
-        # termination_thread = threading.Thread(target=manage_workflow, args=(handle,workflow_id))
-        # termination_thread.start()
+    async with AsyncExitStack() as workers:
+        await start_workers(workers, client)
+        # One workflow id per set of folders. If a backup of them is already running this trigger
+        # joins it and is served by a single follow-up pass once the current one finishes.
+        records = await asyncio.gather(*[
+            start_job(client, job, False, DEFAULT_ON_CONFLICT, DEFAULT_ID_REUSE, by="file_backup3") for job in jobs
+        ])
+        for record in records:
+            print(f"Backup of {record['job']} requested from workflow with ID: {record['workflow_id']}, run {record['run_id']}")
+        workflow_ids = [record["workflow_id"] for record in records]
+
+        # The console shares this loop and client with the workers, folders are approved from here
+        async def wait_for_result(workflow_id: str):
+            try:
+                await client.get_workflow_handle(workflow_id).result()
+            except WorkflowFailureError as e:
+                print(f"Backup {workflow_id} failed or was terminated: {e.cause or e}")
+            else:
+                print(f"Backup {workflow_id} finished")
 
-        try:
-            result = await handle.result()
-            # print("Workflow completed successfully.")
-        except Exception as e:
-            pass
-            # print(f"Workflow failed or was terminated: {e}")
+        await asyncio.gather(console(BackupControl(client), workflow_ids), *[wait_for_result(workflow_id) for workflow_id in workflow_ids])
 
-        # Wait for the termination thread to finish
-        # termination_thread.join()
-    
-   
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,411 @@
+import asyncio
+import dataclasses
+import errno
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import temporalio.converter
+from temporalio import activity
+from temporalio.client import Client
+from temporalio.exceptions import ApplicationError, CancelledError
+from temporalio.worker import ActivityInboundInterceptor, ExecuteActivityInput, Interceptor
+
+from copy_engine import CopyInterrupted, copy_file_parallel, copy_file_to_many, acquire_limiter, plan_read_order, release_limiter, tree_hash
+from payload_codecs import ChainedCodec, ClaimCheckCodec, CompressionCodec
+
+
+logger = logging.getLogger(__name__)
+
+# How often the running copies of a job poll the workflow for pause and throttle changes, and the
+# longest wait between polls while the workflow can't be queried
+CONTROL_REFRESH_SECONDS = 5
+CONTROL_MAX_BACKOFF_SECONDS = 60
+
+# Large payloads such as file lists are kept here, only a reference goes into workflow history.
+# Client and workers must see the same directory, a shared mount once hosts register their own
+# folders. Such hosts leave a marker in it and the client refuses their folders if it can't see it.
+BLOB_DIR = os.environ.get("FILE_BACKUP_BLOB_DIR", os.path.expanduser("~/.file_backup/blobs"))
+
+# Worker processes on this host, set by worker_supervisor. A worker's process pool and piece threads
+# are sized to its share of the cores, not to every core.
+WORKER_PROCESSES = int(os.environ.get("FILE_BACKUP_WORKER_PROCESSES", "1"))
+CORES_PER_WORKER = max(1, (os.cpu_count() or 1) // WORKER_PROCESSES)
+
+# Threads each process pool copy or verify uses for the pieces of a file
+PIECE_THREADS = CORES_PER_WORKER
+
+# Most files a scan stats in one go on its thread, the scan's rate limit makes this smaller
+SCAN_SLICE_FILES = 256
+
+# Activity counters of this worker process, read by the supervisor
+worker_metrics = Counter()
+
+
+def payload_codec() -> ChainedCodec:
+    # Compress first so blobs are stored compressed and mid sized payloads stay inline once compressed
+    return ChainedCodec([CompressionCodec(), ClaimCheckCodec(BLOB_DIR)])
+
+
+async def connect_client() -> Client:
+    # The client, the worker built on it and manage_workflow's handle all share this converter
+    data_converter = dataclasses.replace(temporalio.converter.default(), payload_codec=payload_codec())
+    return await Client.connect("localhost:7233", data_converter=data_converter)
+
+
+_activity_client = None
+
+
+async def activity_client() -> Client:
+    # Activities share one connection per worker process instead of connecting on every call
+    global _activity_client
+    if _activity_client is None:
+        _activity_client = await connect_client()
+    return _activity_client
+
+
+def scan_slice_for(limiter) -> int:
+    # Keep each throttled wait to about a second, like chunk_size_for does for copies
+    rate = limiter.scan_files.rate
+    return int(max(1, min(SCAN_SLICE_FILES, rate))) if rate else SCAN_SLICE_FILES
+
+
+def outdated_files(source_folder: str, root: str, names: List[str], backup_folders: List[str]) -> List[Tuple[str, List[str], int]]:
+    # Blocking, the scan runs it in a thread. Entries for the files in root whose backups need copying.
+    files_to_update = []
+    for file in names:
+        source_file = os.path.join(root, file)
+        relative_path = os.path.relpath(source_file, source_folder)
+        source_stat = os.stat(source_file)
+        source_mtime = source_stat.st_mtime
+        backup_files = []
+        for folder in backup_folders:
+            backup_file = os.path.join(folder, relative_path)
+            if os.path.exists(backup_file):
+                backup_stat = os.stat(backup_file)
+                if source_mtime > backup_stat.st_mtime or source_stat.st_size != backup_stat.st_size:
+                    backup_files.append(backup_file)
+            else:
+                backup_files.append(backup_file)
+        if backup_files:
+            files_to_update.append((source_file, backup_files, source_stat.st_size))
+    return files_to_update
+
+
+@activity.defn
+async def list_files_activity(source_folder: str, backup_folder: Union[str, List[str]], rate_limits: dict = None, read_order: str = "walk",
+                              max_files: int = None) -> Optional[List[Tuple[str, List[str], int]]]:
+    # Each entry is (source_file, backup files that are missing, older than it or of another size, source size in bytes).
+    # Copies don't set the backup's mtime, so a half written backup looks newer than its source, only its size gives it away.
+    # Returns None once more than max_files files are seen, the workflow then scans with a regular activity.
+    backup_folders = [backup_folder] if isinstance(backup_folder, str) else backup_folder
+    files_to_update = []
+
+    if not os.path.exists(source_folder):
+        logger.error(f"Source folder '{source_folder}' does not exist.")
+        raise Exception(f"Source folder '{source_folder}' does not exist.")
+
+    # The scan rate can change while the scan runs, it is polled from the workflow like the copies' limits
+    workflow_id = activity.info().workflow_id
+    limiter = acquire_limiter(workflow_id, rate_limits)
+    await watch_controls(workflow_id, limiter)
+    files_seen = 0
+    # The walk and the stats run in threads, the worker's other activities and workflows share this event loop
+    walk = os.walk(source_folder)
+    try:
+        while True:
+            step = await asyncio.to_thread(next, walk, None)
+            if step is None:
+                break
+            root, _, files = step
+            start = 0
+            while start < len(files):
+                names = files[start:start + scan_slice_for(limiter)]
+                start += len(names)
+                files_seen += len(names)
+                if max_files is not None and files_seen > max_files:
+                    return None
+                await limiter.scan_files.acquire(len(names))
+                files_to_update += await asyncio.to_thread(outdated_files, source_folder, root, names, backup_folders)
+    finally:
+        unwatch_controls(workflow_id)
+        release_limiter(workflow_id)
+    worker_metrics["files_scanned"] += files_seen
+
+    # Copy batches are slices of this list, so ordering it here orders every batch
+    return plan_read_order(files_to_update, read_order)
+
+
+class WorkflowControls:
+    # Polls the workflow in the background while copies or scans of its job run, so pauses and throttle
+    # changes are seen within seconds, even in the middle of a large file. All copies and scans of a job
+    # in this worker process share one poller, see watch_controls.
+    def __init__(self, handle, limiter):
+        self.handle = handle
+        self.limiter = limiter
+        self.paused = False
+        self.users = 0
+        self.task = None
+
+    async def watch(self):
+        delay = CONTROL_REFRESH_SECONDS
+        while True:
+            try:
+                controls = await self.handle.query("get_controls")
+            except Exception as e:
+                delay = min(delay * 2, CONTROL_MAX_BACKOFF_SECONDS)
+                logger.warning(f"Could not read the controls of workflow {self.handle.id}, trying again in {delay}s: {e}")
+            else:
+                delay = CONTROL_REFRESH_SECONDS
+                self.paused = controls["paused"]
+                self.limiter.configure(controls["rate_limits"])
+            await asyncio.sleep(delay)
+
+
+_controls: Dict[str, WorkflowControls] = {}
+
+
+async def watch_controls(workflow_id: str, limiter) -> WorkflowControls:
+    # Every watch_controls is paired with an unwatch_controls once the activity is done
+    client = await activity_client()
+    controls = _controls.get(workflow_id)
+    if controls is None:
+        controls = _controls[workflow_id] = WorkflowControls(client.get_workflow_handle(workflow_id), limiter)
+        controls.task = asyncio.create_task(controls.watch())
+    controls.users += 1
+    return controls
+
+
+def unwatch_controls(workflow_id: str):
+    controls = _controls[workflow_id]
+    controls.users -= 1
+    if not controls.users:
+        controls.task.cancel()
+        del _controls[workflow_id]
+
+
+def failure_entry(source_file: str, backup_file: str, error: Exception, attempts: int = 1) -> list:
+    # Compact ledger row: [source, backup, errno, attempts]
+    return [source_file, backup_file, getattr(error, "errno", None), attempts]
+
+
+def last_checkpoint() -> dict:
+    # Progress heartbeated by the previous attempt of this activity, empty on the first attempt
+    details = activity.info().heartbeat_details
+    return details[0] if details and isinstance(details[0], dict) else {}
+
+
+def shutdown_check() -> Optional[Callable[[], bool]]:
+    # Local activities have no heartbeat to checkpoint to, they are small enough to just finish
+    return None if activity.info().is_local else activity.is_worker_shutdown
+
+
+def partial_checkpoint(source_file: str, backup_files: List[str], offset: int) -> Optional[dict]:
+    try:
+        stat = os.stat(source_file)
+    except OSError:
+        return None
+    return {"source_file": source_file, "backup_files": backup_files, "offset": offset,
+            "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def chunk_heartbeat(details: dict, source_file: str, backup_files: List[str], offset: int) -> Callable[[int], None]:
+    # Heartbeats the details and how far the current file is written, so an attempt that times out or
+    # loses its worker is continued from there by the next one instead of starting the file over
+    checkpoint = partial_checkpoint(source_file, backup_files, offset)
+    return lambda written: activity.heartbeat(dict(details, partial=checkpoint and dict(checkpoint, offset=written)))
+
+
+def resume_point(partial: Optional[dict], source_file: str) -> Optional[Tuple[List[str], int]]:
+    # (backup files, offset) to continue a file cut off by a worker shutdown, None if it has to start over
+    # because the source or one of the backups changed in the meantime
+    if not partial or partial["source_file"] != source_file:
+        return None
+    try:
+        stat = os.stat(source_file)
+        if (stat.st_size, stat.st_mtime_ns) != (partial["size"], partial["mtime_ns"]):
+            return None
+        if any(os.path.getsize(backup_file) < partial["offset"] for backup_file in partial["backup_files"]):
+            return None
+    except OSError:
+        return None
+    return partial["backup_files"], partial["offset"]
+
+
+def worker_shutdown_error() -> ApplicationError:
+    # Retryable, the next attempt picks up from the checkpoint heartbeated just before
+    return ApplicationError("Worker shutting down, resuming from checkpoint", type="WorkerShutdown")
+
+
+@activity.defn
+async def copy_files_activity(files_to_update: List[Tuple[str, List[str], int]], source_folder: str, workflow_id: str, rate_limits: dict = None, io_options: dict = None):
+    limiter = acquire_limiter(workflow_id, rate_limits)
+    controls = await watch_controls(workflow_id, limiter)
+    # Every chunk heartbeats the offset reached, and a worker shutdown stops the copy between chunks and
+    # heartbeats where it stopped, so a retry skips the files already done and continues the current one
+    checkpoint = last_checkpoint()
+    files_processed = checkpoint.get("files_processed", 0)
+    failures = checkpoint.get("failures", [])
+    partial = checkpoint.get("partial")
+    should_stop = shutdown_check()
+    heartbeat = lambda: activity.heartbeat({"files_processed": files_processed, "failures": failures})
+    try:
+        for source_file, backup_files, size in files_to_update[files_processed:]:
+            if should_stop and should_stop():
+                heartbeat()
+                raise worker_shutdown_error()
+            offset = 0
+            resume = resume_point(partial, source_file)
+            if resume:
+                backup_files, offset = resume
+            partial = None
+            on_chunk = chunk_heartbeat({"files_processed": files_processed, "failures": failures}, source_file, backup_files, offset)
+            # Each source is read once and written to all of its stale destinations
+            try:
+                failed = await copy_file_to_many(source_file, backup_files, limiter, on_chunk, **(io_options or {}),
+                                                 offset=offset, should_stop=should_stop)
+            except CopyInterrupted as e:
+                failures.extend(failure_entry(source_file, backup_file, error) for backup_file, error in e.failures.items())
+                remaining = [backup_file for backup_file in backup_files if backup_file not in e.failures]
+                activity.heartbeat({"files_processed": files_processed, "failures": failures,
+                                    "partial": partial_checkpoint(source_file, remaining, e.offset)})
+                raise worker_shutdown_error()
+            failures.extend(failure_entry(source_file, backup_file, e) for backup_file, e in failed.items())
+            files_processed += 1
+            worker_metrics["files_copied"] += 1
+            worker_metrics["bytes_read"] += size - offset
+            worker_metrics["copy_failures"] += len(failed)
+            heartbeat()
+
+            if controls.paused:
+                return "PAUSE", files_processed, failures
+    finally:
+        unwatch_controls(workflow_id)
+        release_limiter(workflow_id)
+
+    return "SUCCESS", files_processed, failures
+
+
+@activity.defn
+async def retry_failed_files_activity(failures: List[list], source_folder: str, rate_limits: dict = None, io_options: dict = None) -> List[list]:
+    # Only the ledger rows are retried, never the whole folder
+    workflow_id = activity.info().workflow_id
+    limiter = acquire_limiter(workflow_id, rate_limits)
+    await watch_controls(workflow_id, limiter)
+    # Rows of the same source failed on different destinations are retried with a single read
+    attempts_by_backup = {}
+    for source_file, backup_file, _, attempts in failures:
+        attempts_by_backup.setdefault(source_file, {})[backup_file] = attempts
+    # Checkpointed every chunk and on worker shutdown like copy_files_activity
+    checkpoint = last_checkpoint()
+    sources_done = checkpoint.get("sources_done", 0)
+    still_failing = checkpoint.get("still_failing", [])
+    partial = checkpoint.get("partial")
+    should_stop = shutdown_check()
+    heartbeat = lambda: activity.heartbeat({"sources_done": sources_done, "still_failing": still_failing})
+    try:
+        for source_file, attempts in list(attempts_by_backup.items())[sources_done:]:
+            if should_stop and should_stop():
+                heartbeat()
+                raise worker_shutdown_error()
+            backup_files, offset = resume_point(partial, source_file) or (list(attempts), 0)
+            partial = None
+            on_chunk = chunk_heartbeat({"sources_done": sources_done, "still_failing": still_failing}, source_file, backup_files, offset)
+            try:
+                failed = await copy_file_to_many(source_file, backup_files, limiter, on_chunk, **(io_options or {}),
+                                                 offset=offset, should_stop=should_stop)
+            except CopyInterrupted as e:
+                still_failing.extend(failure_entry(source_file, backup_file, error, attempts[backup_file] + 1) for backup_file, error in e.failures.items())
+                remaining = [backup_file for backup_file in backup_files if backup_file not in e.failures]
+                activity.heartbeat({"sources_done": sources_done, "still_failing": still_failing,
+                                    "partial": partial_checkpoint(source_file, remaining, e.offset)})
+                raise worker_shutdown_error()
+            still_failing.extend(failure_entry(source_file, backup_file, e, attempts[backup_file] + 1) for backup_file, e in failed.items())
+            sources_done += 1
+            worker_metrics["files_retried"] += 1
+            worker_metrics["copy_failures"] += len(failed)
+            heartbeat()
+    finally:
+        unwatch_controls(workflow_id)
+        release_limiter(workflow_id)
+    return still_failing
+
+
+@activity.defn
+def copy_files_sync_activity(files_to_update: List[Tuple[str, List[str], int]], source_folder: str):
+    # Blocking variant of copy_files_activity for the worker's process pool. Large files are split into
+    # pieces copied and tree hashed on PIECE_THREADS threads, so one big file keeps every core busy.
+    # There is no rate limiter or pause polling in here, the workflow only uses it for unthrottled copies
+    # and pauses it between batches. Pieces finish out of order, so a worker shutdown is checkpointed
+    # between files only. Along with the usual result it returns the tree digest of every source copied
+    # to all its backups, for verify_files_activity, and last this attempt's counts for worker_metrics.
+    checkpoint = last_checkpoint()
+    files_processed = checkpoint.get("files_processed", 0)
+    failures = checkpoint.get("failures", [])
+    digests = checkpoint.get("digests", {})
+    metrics = Counter()
+    heartbeat = lambda: activity.heartbeat({"files_processed": files_processed, "failures": failures, "digests": digests})
+    with ThreadPoolExecutor(PIECE_THREADS) as pool:
+        for source_file, backup_files, size in files_to_update[files_processed:]:
+            if activity.is_cancelled():
+                raise CancelledError("Copy cancelled")
+            if activity.is_worker_shutdown():
+                heartbeat()
+                raise worker_shutdown_error()
+            digest, failed = copy_file_parallel(source_file, backup_files, pool, on_chunk=heartbeat)
+            failures.extend(failure_entry(source_file, backup_file, e) for backup_file, e in failed.items())
+            if digest and not failed:
+                digests[source_file] = digest
+            files_processed += 1
+            metrics.update(files_copied=1, bytes_read=size, copy_failures=len(failed))
+            heartbeat()
+    return "SUCCESS", files_processed, failures, digests, dict(metrics)
+
+
+@activity.defn
+def verify_files_activity(files_to_verify: List[Tuple[str, List[str], int]], digests: Optional[Dict[str, str]] = None) -> Tuple[List[list], dict]:
+    # Tree hashes each source and its backup files on the worker's process pool, returning ledger rows
+    # for the backup files that differ from their source or can't be read, and the counts for worker_metrics.
+    # Sources in digests were hashed while they were copied, only their backups are read again.
+    digests = digests or {}
+    mismatches = []
+    metrics = Counter()
+    with ThreadPoolExecutor(PIECE_THREADS) as pool:
+        for files_verified, (source_file, backup_files, _) in enumerate(files_to_verify):
+            if activity.is_cancelled():
+                raise CancelledError("Verify cancelled")
+            heartbeat = lambda: activity.heartbeat(files_verified)
+            try:
+                source_digest = digests.get(source_file) or tree_hash(source_file, pool, on_chunk=heartbeat)
+            except Exception as e:
+                mismatches.extend(failure_entry(source_file, backup_file, e) for backup_file in backup_files)
+                continue
+            for backup_file in backup_files:
+                try:
+                    if tree_hash(backup_file, pool, on_chunk=heartbeat) != source_digest:
+                        raise OSError(errno.EIO, "Backup does not match the source", backup_file)
+                except Exception as e:
+                    mismatches.append(failure_entry(source_file, backup_file, e))
+            metrics["files_verified"] += 1
+    return mismatches, dict(metrics)
+
+
+# Activities run on the worker's process pool, where worker_metrics is the pool process's own copy
+PROCESS_POOL_ACTIVITIES = (copy_files_sync_activity, verify_files_activity)
+
+
+class WorkerMetricsInterceptor(Interceptor):
+    # Adds the counts process pool activities return as the last item of their result to this worker
+    # process's worker_metrics, the one the supervisor reads
+    def intercept_activity(self, next: ActivityInboundInterceptor) -> ActivityInboundInterceptor:
+        return ProcessPoolMetrics(next)
+
+
+class ProcessPoolMetrics(ActivityInboundInterceptor):
+    async def execute_activity(self, input: ExecuteActivityInput):
+        result = await super().execute_activity(input)
+        if input.fn in PROCESS_POOL_ACTIVITIES:
+            worker_metrics.update(result[-1])
+        return result
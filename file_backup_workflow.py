@@ -0,0 +1,901 @@
+import asyncio
+import heapq
+from datetime import timedelta
+from typing import List, Optional, Tuple, Union
+
+from temporalio import workflow
+from temporalio.common import RetryPolicy
+from temporalio.exceptions import ActivityError, ChildWorkflowError
+
+# The sandbox re-imports this module for every workflow run, so it holds the workflows and nothing
+# else. Activities and helpers are passed through: imported once by the worker and shared by all runs.
+with workflow.unsafe.imports_passed_through():
+    from file_backup_activities import (
+        copy_files_activity,
+        copy_files_sync_activity,
+        list_files_activity,
+        retry_failed_files_activity,
+        verify_files_activity,
+    )
+    from host_registry import host_task_queue
+
+
+# Rounds of targeted retries for files in the failure ledger, doubling the wait each round
+FAILED_FILE_RETRY_ROUNDS = 3
+FAILED_FILE_RETRY_BACKOFF = timedelta(seconds=10)
+
+# Default size of a copy batch and how many batches of a folder are copied at once
+DEFAULT_BATCH_BYTES = 256 * 1024 * 1024
+DEFAULT_BATCH_FILES = 500
+DEFAULT_BATCH_WINDOW = 4
+
+# Settings that can be changed on a running workflow with set_throttle / update_throttle
+RATE_LIMIT_KEYS = ("bytes_per_second", "files_per_second", "scan_files_per_second")
+THROTTLE_KEYS = RATE_LIMIT_KEYS + ("max_concurrent_copies", "batch_window")
+
+# Limits under which scans and copy batches of unthrottled jobs run as local activities, and the
+# attempts a local activity gets before its work goes to a regular activity
+DEFAULT_LOCAL_SCAN_MAX_FILES = 1000
+DEFAULT_LOCAL_COPY_MAX_FILES = 50
+DEFAULT_LOCAL_COPY_MAX_BYTES = 16 * 1024 * 1024
+LOCAL_ACTIVITY_ATTEMPTS = 3
+
+# History size at which a run continues as new, well below the server's hard limits
+DEFAULT_MAX_HISTORY_EVENTS = 10_000
+DEFAULT_MAX_HISTORY_BYTES = 10 * 1024 * 1024
+
+# Fixed cost of a file (open, create, metadata) expressed in bytes when balancing batches
+DEFAULT_PER_FILE_OVERHEAD_BYTES = 256 * 1024
+
+# Copy and verify activities get COPY_TIMEOUT_BASE plus the time their bytes take at the job's rate
+# limits, never assuming more than MIN_COPY_BYTES_PER_SECOND. Retries don't know their files' sizes and
+# get RETRY_COPY_TIMEOUT. A copy that stalls is caught well before either by its heartbeat timeout.
+COPY_TIMEOUT_BASE = timedelta(minutes=5)
+MIN_COPY_BYTES_PER_SECOND = 4 * 1024 * 1024
+RETRY_COPY_TIMEOUT = timedelta(hours=24)
+
+# Workflow tasks (and with them signals, queries, updates and local activities) have a queue of their
+# own, and so has each activity class, so a flood of copies never holds up scans or the workflow
+# tasks that unblock other jobs
+TASK_QUEUE = "file-backup-task-queue"
+SCAN_TASK_QUEUE = "file-backup-scan"
+COPY_TASK_QUEUE = "file-backup-copy"
+VERIFY_TASK_QUEUE = "file-backup-verify"
+
+
+def file_cost(entry: Tuple[str, List[str], int], per_file_overhead_bytes: int) -> int:
+    # Estimated work for one file in bytes, the fixed cost of opening and creating files counts too
+    return entry[2] + per_file_overhead_bytes
+
+
+def plan_copy_batches(files_to_update: List[Tuple[str, List[str], int]], batch_bytes: int, batch_files: int,
+                      per_file_overhead_bytes: int) -> List[list]:
+    # Longest processing time first: the most expensive files are placed first, each on the least loaded batch,
+    # so big files start early and small files fill the gaps. Batches come back heaviest first, each keeping scan (read) order.
+    costs = [file_cost(entry, per_file_overhead_bytes) for entry in files_to_update]
+    # A file that fills a batch by itself gets its own, the rest are spread over just enough batches
+    members = [[position] for position in range(len(files_to_update)) if costs[position] >= batch_bytes]
+    rest = [position for position in range(len(files_to_update)) if costs[position] < batch_bytes]
+    if rest:
+        batch_count = max(-(-sum(costs[position] for position in rest) // batch_bytes), -(-len(rest) // batch_files))
+        loads = [(0, index) for index in range(len(members), len(members) + batch_count)]
+        members += [[] for _ in range(batch_count)]
+        for position in sorted(rest, key=lambda position: -costs[position]):
+            full = []
+            load, index = heapq.heappop(loads)
+            while len(members[index]) >= batch_files:
+                full.append((load, index))
+                load, index = heapq.heappop(loads)
+            members[index].append(position)
+            heapq.heappush(loads, (load + costs[position], index))
+            for entry in full:
+                heapq.heappush(loads, entry)
+    batch_load = [sum(costs[position] for position in batch) for batch in members]
+    order = sorted(range(len(members)), key=lambda index: (-batch_load[index], index))
+    return [[files_to_update[position] for position in sorted(members[index])] for index in order if members[index]]
+
+
+def plan_ordered_batches(files_to_update: List[Tuple[str, List[str], int]], batch_bytes: int, batch_files: int,
+                         per_file_overhead_bytes: int) -> List[list]:
+    # For scans in inode or extent order: every batch is a run of neighbouring files, cut so the batches
+    # carry about the same bytes. Spreading neighbours over all batches like plan_copy_batches would have
+    # the batch window seek all over the disk again. Batches come back in read order.
+    costs = [file_cost(entry, per_file_overhead_bytes) for entry in files_to_update]
+    if not files_to_update:
+        return []
+    batch_count = max(-(-sum(costs) // batch_bytes), -(-len(files_to_update) // batch_files))
+    target = sum(costs) / batch_count
+    batches = []
+    current = None
+    done = 0
+    for entry, cost in zip(files_to_update, costs):
+        # A file belongs to the batch its middle byte falls into
+        index = min(batch_count - 1, int((done + cost / 2) // target)) if target else 0
+        done += cost
+        if index != current or len(batches[-1]) >= batch_files:
+            batches.append([])
+            current = index
+        batches[-1].append(entry)
+    return batches
+
+
+def makespan_report(batches: List[list], window: int, per_file_overhead_bytes: int) -> dict:
+    # Estimated makespan of running the batches largest first on `window` slots, against the best any plan could do
+    batch_costs = [sum(file_cost(entry, per_file_overhead_bytes) for entry in batch) for batch in batches]
+    slots = [0] * max(1, window)
+    for cost in batch_costs:
+        slots[slots.index(min(slots))] += cost
+    largest_file = max((file_cost(entry, per_file_overhead_bytes) for batch in batches for entry in batch), default=0)
+    lower_bound = max(sum(batch_costs) / len(slots), largest_file)
+    makespan = max(slots)
+    return {
+        "batches": len(batches),
+        "makespan_bytes": makespan,
+        "lower_bound_bytes": lower_bound,
+        "ratio": round(makespan / lower_bound, 3) if lower_bound else 1.0,
+    }
+
+
+@workflow.defn
+class FileBackupWorkflow:
+    def __init__(self):
+        self.paused = False
+        self.files_copied = {}
+        self.failed_files = {}
+        self.rate_limits = {}
+        self.io_options = {}
+        self.destinations = []
+        self.destination_copied = {}
+        self.approvals = {}
+        self.pending_approval = {}
+        self.auto_approve = None
+        self.folder_progress = {}
+        self.max_concurrent_copies = None
+        self.active_copies = 0
+        self.batch_bytes = DEFAULT_BATCH_BYTES
+        self.batch_files = DEFAULT_BATCH_FILES
+        self.batch_window = DEFAULT_BATCH_WINDOW
+        self.batch_results = {}
+        self.batches_in_flight = {}
+        self.per_file_overhead_bytes = DEFAULT_PER_FILE_OVERHEAD_BYTES
+        self.batch_plans = {}
+        self.max_history_events = DEFAULT_MAX_HISTORY_EVENTS
+        self.max_history_bytes = DEFAULT_MAX_HISTORY_BYTES
+        self.draining = False
+        self.deferred_folders = set()
+        self.runs = 1
+        self.children = {}
+        self.child_folders = set()
+        self.child_destination_failed = {}
+        self.local_scan_max_files = DEFAULT_LOCAL_SCAN_MAX_FILES
+        self.local_copy_max_files = DEFAULT_LOCAL_COPY_MAX_FILES
+        self.local_copy_max_bytes = DEFAULT_LOCAL_COPY_MAX_BYTES
+        self.copy_mode = "async"
+        self.read_order = "walk"
+        self.verify_copies = False
+        self.copy_digests = {}
+        self.passes = 1
+        self.pending_triggers = 0
+        self.last_trigger = None
+        self.folder_hosts = {}
+
+    @workflow.query
+    def is_paused(self) -> bool:
+        return self.paused
+
+    @workflow.query
+    def failed_files_ledger(self) -> dict:
+        return self.failed_files
+
+    @workflow.query
+    def get_rate_limits(self) -> dict:
+        return self.rate_limits
+
+    @workflow.query
+    def get_controls(self) -> dict:
+        # Everything a running copy activity needs to follow, in one query
+        return {"paused": self.paused, "rate_limits": self.rate_limits}
+
+    @workflow.query
+    def get_throttle(self) -> dict:
+        return dict(self.rate_limits, max_concurrent_copies=self.max_concurrent_copies, batch_window=self.batch_window)
+
+    @workflow.query
+    def get_folder_progress(self) -> dict:
+        return self.folder_progress
+
+    @workflow.query
+    def get_batch_results(self) -> dict:
+        return self.batch_results
+
+    @workflow.query
+    def get_batch_plans(self) -> dict:
+        return self.batch_plans
+
+    @workflow.query
+    def pending_approvals(self) -> dict:
+        return self.pending_approval
+
+    @workflow.query
+    def destination_status(self) -> dict:
+        # Child workflows only report their failure counts, their ledgers stay in their own histories
+        failed = {destination: self.child_destination_failed.get(destination, 0) for destination in self.destinations}
+        for failures in self.failed_files.values():
+            for _, backup_file, _, _ in failures:
+                failed[self.destination_of(backup_file)] += 1
+        return {
+            destination: {"copied": self.destination_copied[destination], "failed": failed[destination]}
+            for destination in self.destinations
+        }
+
+    @workflow.query
+    def get_triggers(self) -> dict:
+        # Backup requests that arrived during this pass, all of them are served by one follow-up pass
+        return {"pass": self.passes, "pending_triggers": self.pending_triggers, "last_trigger": self.last_trigger}
+
+    @workflow.query
+    def get_hosts(self) -> List[str]:
+        # Hosts owning any of the job's folders, used to pick jobs by host
+        return sorted(set(self.folder_hosts.values()))
+    
+    @workflow.run
+    async def run(self, source_folders: List[str], backup_folder: Union[str, List[str]], workflow_id: str, options: dict = None,
+                  carry_over: dict = None) -> dict:
+        print("Starting file backup workflow with parallel list and copy files.")
+        options = options or {}
+        # Several destinations are filled from a single read of each source file
+        self.destinations = [backup_folder] if isinstance(backup_folder, str) else list(backup_folder)
+        self.destination_copied = {destination: 0 for destination in self.destinations}
+        # Per job limits, e.g. {"bytes_per_second": 50_000_000, "files_per_second": 200, "scan_files_per_second": 1000}
+        self.rate_limits = dict(options.get("rate_limits") or {})
+        # "cache_neutral" keeps backups from evicting the host's page cache, "direct" also reads large files with O_DIRECT
+        self.io_options = {"io_mode": options.get("io_mode", "buffered")}
+        if "direct_io_min_bytes" in options:
+            self.io_options["direct_io_min_bytes"] = options["direct_io_min_bytes"]
+        if "fanout_stall_seconds" in options:
+            self.io_options["stall_seconds"] = options["fanout_stall_seconds"]
+        # "inode" or "extent" reads sources in on-disk order, for HDD backed volumes
+        self.read_order = options.get("read_order", "walk")
+        # True approves every folder, {"max_files": N, "max_bytes": X} approves folders within both limits
+        self.auto_approve = options.get("auto_approve")
+        
+        # None means no cap on copy activities running at once across all folders
+        self.max_concurrent_copies = options.get("max_concurrent_copies")
+        # Folders are copied in byte balanced batches of about batch_bytes (at most batch_files), batch_window of them in flight per folder
+        self.batch_bytes = options.get("batch_bytes", DEFAULT_BATCH_BYTES)
+        self.batch_files = options.get("batch_files", DEFAULT_BATCH_FILES)
+        self.batch_window = options.get("batch_window", DEFAULT_BATCH_WINDOW)
+        self.per_file_overhead_bytes = options.get("per_file_overhead_bytes", DEFAULT_PER_FILE_OVERHEAD_BYTES)
+        # Small scans and copies run as local activities, 0 turns the fast path off
+        self.local_scan_max_files = options.get("local_scan_max_files", DEFAULT_LOCAL_SCAN_MAX_FILES)
+        self.local_copy_max_files = options.get("local_copy_max_files", DEFAULT_LOCAL_COPY_MAX_FILES)
+        self.local_copy_max_bytes = options.get("local_copy_max_bytes", DEFAULT_LOCAL_COPY_MAX_BYTES)
+        # "process" copies large batches on the worker's process pool with parallel tree hashing,
+        # verify_copies re-hashes every backup file against its source once a folder is copied
+        self.copy_mode = options.get("copy_mode", "async")
+        self.verify_copies = options.get("verify_copies", False)
+        # {folder: host} for folders on a host's local disk, their activities only go to that host's workers
+        self.folder_hosts = options.get("folder_hosts") or {}
+        # Past either limit the run winds down and continues as new with a compact carry over state
+        self.max_history_events = options.get("max_history_events", DEFAULT_MAX_HISTORY_EVENTS)
+        self.max_history_bytes = options.get("max_history_bytes", DEFAULT_MAX_HISTORY_BYTES)
+
+        done_folders = []
+        if carry_over:
+            done_folders = self.restore_carry_over(carry_over)
+            print(f"Continuing backup, run {self.runs}, {len(done_folders)} folders already done")
+        if not carry_over or carry_over.get("follow_up"):
+            # Requests delivered with the start (signal-with-start) are served by the pass starting now
+            self.pending_triggers = 0
+
+        # Every folder runs its own scan -> approve -> copy pipeline, so a slow folder never holds up the others.
+        # With child_workflows each pipeline gets its own child workflow, history and retries instead.
+        if options.get("child_workflows"):
+            self.child_folders = {folder for folder in source_folders if folder not in done_folders}
+            await asyncio.gather(*[
+                self.backup_in_child_workflow(folder, index, workflow_id, options)
+                for index, folder in enumerate(source_folders)
+                if folder not in done_folders
+            ])
+        else:
+            await asyncio.gather(*[
+                self.backup_source_folder(folder, workflow_id)
+                for folder in source_folders
+                if folder not in done_folders
+            ])
+
+        if self.deferred_folders:
+            await workflow.wait_condition(workflow.all_handlers_finished)
+            print(f"History limit reached, continuing as new with {len(self.deferred_folders)} folders left")
+            workflow.continue_as_new(args=[source_folders, backup_folder, workflow_id, options, self.carry_over_state(source_folders)])
+        if self.pending_triggers:
+            # However many requests came in while this pass ran, one more pass picks up what changed meanwhile.
+            # The scan skips files whose backups are current, so it only copies the difference.
+            await workflow.wait_condition(workflow.all_handlers_finished)
+            print(f"{self.pending_triggers} backup requests arrived during pass {self.passes}, starting a follow-up pass")
+            workflow.continue_as_new(args=[source_folders, backup_folder, workflow_id, options, self.follow_up_state()])
+        return self.summary()
+
+    def summary(self) -> dict:
+        return {
+            "pass": self.passes,
+            "folder_progress": self.folder_progress,
+            "files_copied": self.files_copied,
+            "failed_files": {folder: len(rows) for folder, rows in self.failed_files.items()},
+            "destination_status": self.destination_status(),
+        }
+
+    async def backup_in_child_workflow(self, source_folder: str, index: int, workflow_id: str, options: dict):
+        child_id = f"{workflow_id}-folder-{index}"
+        self.folder_progress[source_folder] = {"stage": "running in child workflow", "files": 0, "error": None, "child_workflow_id": child_id}
+        # Settings changed on the parent so far are handed down, later changes are forwarded as signals
+        child_options = dict(
+            options,
+            child_workflows=False,
+            rate_limits=self.child_rate_limits(),
+            batch_window=self.batch_window,
+            max_concurrent_copies=self.child_copy_cap(),
+        )
+        try:
+            handle = await workflow.start_child_workflow(
+                FolderBackupWorkflow.run,
+                args=[[source_folder], self.destinations, child_id, child_options],
+                id=child_id,
+            )
+            self.children[source_folder] = handle
+            if self.paused:
+                await handle.signal(FolderBackupWorkflow.pause_backup)
+            approved = [folder for folder, decision in self.approvals.items() if decision]
+            rejected = [folder for folder, decision in self.approvals.items() if not decision]
+            if approved:
+                await handle.signal(FolderBackupWorkflow.approve_folders, approved)
+            if rejected:
+                await handle.signal(FolderBackupWorkflow.reject_folders, rejected)
+            child_summary = await handle
+        except ChildWorkflowError as e:
+            self.folder_progress[source_folder].update(stage="failed", error=str(e.cause or e))
+            print(f"\nError processing folder {source_folder}: {e.cause or e}\n")
+            return
+        finally:
+            self.children.pop(source_folder, None)
+            self.child_folders.discard(source_folder)
+            self.pending_approval.pop(source_folder, None)
+            self.share_throttle()
+
+        self.folder_progress[source_folder] = dict(child_summary["folder_progress"][source_folder], child_workflow_id=child_id)
+        self.files_copied[source_folder] = child_summary["files_copied"].get(source_folder, 0)
+        for destination, status in child_summary["destination_status"].items():
+            self.destination_copied[destination] += status["copied"]
+            self.child_destination_failed[destination] = self.child_destination_failed.get(destination, 0) + status["failed"]
+
+    def forward_to_children(self, signal: str, *args):
+        for handle in self.children.values():
+            asyncio.create_task(handle.signal(signal, args=list(args)))
+
+    def child_rate_limits(self) -> dict:
+        # Every child throttles its own copies, so the job's rates are split evenly between the children
+        # still running to keep the job as a whole within them
+        children = max(1, len(self.child_folders))
+        return {key: value / children if value else value for key, value in self.rate_limits.items()}
+
+    def child_copy_cap(self) -> Optional[int]:
+        # The copy cap is split the same way, every child keeps at least one copy going
+        if self.max_concurrent_copies is None:
+            return None
+        return max(1, self.max_concurrent_copies // max(1, len(self.child_folders)))
+
+    def share_throttle(self):
+        # Re-split the rates and the copy cap once a child finishes or they change, so the children left get the freed share
+        if self.rate_limits or self.max_concurrent_copies is not None:
+            self.forward_to_children("set_throttle", dict(self.child_rate_limits(), max_concurrent_copies=self.child_copy_cap()))
+
+    async def report_pending_approval(self, source_folder: str):
+        # A child's folders are reviewed through its parent, so it tells the parent what waits for approval
+        parent = workflow.info().parent
+        if parent:
+            await workflow.get_external_workflow_handle(parent.workflow_id).signal(
+                FileBackupWorkflow.child_approval_pending, args=[source_folder, self.pending_approval.get(source_folder)]
+            )
+
+    def history_limit_reached(self) -> bool:
+        info = workflow.info()
+        return (
+            info.is_continue_as_new_suggested()
+            or info.get_current_history_length() >= self.max_history_events
+            or info.get_current_history_size() >= self.max_history_bytes
+        )
+
+    def check_history(self):
+        # Once set, no new scans or batches are started and the run continues as new after in flight work finishes
+        if not self.draining and self.history_limit_reached():
+            self.draining = True
+
+    def defer_folder(self, source_folder: str):
+        self.deferred_folders.add(source_folder)
+        self.folder_progress[source_folder]["stage"] = "deferred"
+
+    def carry_over_state(self, source_folders: List[str]) -> dict:
+        # Unfinished folders carry no manifest: the next run rescans them and the scan skips every file
+        # whose backup has the source's size and isn't older, so copying resumes where this run stopped.
+        # A failed copy can leave a backup that passes that check (process pool copies size it up front), so the ledger
+        # of every folder is carried over and the next run retries its rows.
+        done_folders = [folder for folder in source_folders if folder not in self.deferred_folders]
+        return {
+            "runs": self.runs + 1,
+            "done_folders": done_folders,
+            "folder_progress": {folder: self.folder_progress[folder] for folder in done_folders if folder in self.folder_progress},
+            "files_copied": self.files_copied,
+            "destination_copied": self.destination_copied,
+            "failed_files": self.failed_files,
+            "approvals": self.approvals,
+            "paused": self.paused,
+            "rate_limits": self.rate_limits,
+            "batch_window": self.batch_window,
+            "max_concurrent_copies": self.max_concurrent_copies,
+            "passes": self.passes,
+            "pending_triggers": self.pending_triggers,
+        }
+
+    def follow_up_state(self) -> dict:
+        # A follow-up pass starts with every folder to do and fresh counts, approvals included, but keeps
+        # the pause state and the throttle settings of this one. Files still failing are kept in the
+        # ledger and retried, the rescan alone may not find them (see carry_over_state).
+        return dict(
+            self.carry_over_state([]),
+            done_folders=[],
+            folder_progress={},
+            files_copied={},
+            destination_copied={},
+            failed_files={folder: rows for folder, rows in self.failed_files.items() if rows},
+            approvals={},
+            passes=self.passes + 1,
+            pending_triggers=0,
+            follow_up=True,
+        )
+
+    def restore_carry_over(self, carry_over: dict) -> List[str]:
+        self.runs = carry_over["runs"]
+        self.folder_progress = carry_over["folder_progress"]
+        self.files_copied = carry_over["files_copied"]
+        self.destination_copied.update(carry_over["destination_copied"])
+        self.failed_files = carry_over["failed_files"]
+        self.approvals = carry_over["approvals"]
+        self.paused = carry_over["paused"]
+        # Settings changed while the previous run was going win over the start options
+        self.rate_limits = carry_over["rate_limits"]
+        self.batch_window = carry_over["batch_window"]
+        self.max_concurrent_copies = carry_over["max_concurrent_copies"]
+        # Runs continued before passes existed carry neither key
+        self.passes = carry_over.get("passes", 1)
+        # Requests that arrived while the previous run of this pass was going still get their follow-up
+        self.pending_triggers += carry_over.get("pending_triggers", 0)
+        return carry_over["done_folders"]
+
+    async def backup_source_folder(self, source_folder: str, workflow_id: str):
+        self.folder_progress[source_folder] = {"stage": "scanning", "files": 0, "error": None}
+        try:
+            files_to_update = await self.scan_folder(source_folder)
+            self.check_history()
+            self.drop_rescanned_failures(source_folder, files_to_update)
+            self.folder_progress[source_folder]["files"] = len(files_to_update)
+            await self.process_folder(source_folder, files_to_update, self.destinations, workflow_id)
+        except ActivityError as e:
+            self.folder_progress[source_folder].update(stage="failed", error=str(e.cause or e))
+            print(f"\nError processing folder {source_folder}: {e.cause or e}\n")
+
+    def drop_rescanned_failures(self, source_folder: str, files_to_update: List[Tuple[str, List[str], int]]):
+        # Carried over ledger rows for backups the scan found stale again are redone by the copy itself
+        rescanned = {backup_file for _, backup_files, _ in files_to_update for backup_file in backup_files}
+        if self.failed_files.get(source_folder):
+            self.failed_files[source_folder] = [row for row in self.failed_files[source_folder] if row[1] not in rescanned]
+
+    def task_queue_for(self, task_queue: str, source_folder: str) -> str:
+        return host_task_queue(task_queue, self.folder_hosts.get(source_folder))
+
+    def runs_anywhere(self, source_folder: str) -> bool:
+        # Local activities run wherever the workflow runs, only folders no host owns can take the fast path
+        return source_folder not in self.folder_hosts
+
+    def is_throttled(self, keys: Tuple[str, ...]) -> bool:
+        return any(self.rate_limits.get(key) for key in keys)
+
+    async def scan_folder(self, source_folder: str) -> List[Tuple[str, List[str], int]]:
+        # Try a capped scan as a local activity first: no task queue round trip and no activity events in history.
+        # A throttled scan can't be expected to finish within the local timeout, it goes straight to the scan pool.
+        if self.local_scan_max_files and self.runs_anywhere(source_folder) and not self.is_throttled(("scan_files_per_second",)):
+            try:
+                files_to_update = await workflow.execute_local_activity(
+                    list_files_activity,
+                    args=[source_folder, self.destinations, self.rate_limits, self.read_order, self.local_scan_max_files],
+                    start_to_close_timeout=timedelta(seconds=30),
+                    retry_policy=RetryPolicy(maximum_attempts=LOCAL_ACTIVITY_ATTEMPTS),
+                )
+                if files_to_update is not None:
+                    return files_to_update
+            except ActivityError as e:
+                print(f"Local scan of {source_folder} failed ({e.cause or e}), scanning it with a regular activity")
+        return await workflow.execute_activity(
+            list_files_activity,
+            args=[source_folder, self.destinations, self.rate_limits, self.read_order],
+            task_queue=self.task_queue_for(SCAN_TASK_QUEUE, source_folder),
+            start_to_close_timeout=timedelta(minutes=5),
+            retry_policy=RetryPolicy(maximum_attempts=3),
+        )
+
+    async def process_folder(self, source_folder: str, files_to_update: List[Tuple[str, List[str], int]], backup_folder: Union[str, List[str]], workflow_id: str):
+        if len(files_to_update) > 0:
+            self.folder_progress[source_folder]["stage"] = "awaiting approval"
+            approved = await self.wait_for_approval(source_folder, files_to_update)
+            if approved is None:
+                self.defer_folder(source_folder)
+                return
+            if not approved:
+                self.folder_progress[source_folder]["stage"] = "rejected"
+                print(f"Copy files task for {source_folder} was rejected. Skipping folder.")
+                return
+
+            # Only copy files once the folder is approved
+            self.folder_progress[source_folder]["stage"] = "copying"
+            batches = self.plan_batches(files_to_update)
+            self.batch_plans[source_folder] = makespan_report(batches, self.batch_window, self.per_file_overhead_bytes)
+            print(f"Copy plan for {source_folder}: {self.batch_plans[source_folder]}")
+            self.batch_results[source_folder] = [
+                {"files": len(batch), "bytes": sum(size for _, _, size in batch), "status": "pending", "copied": 0, "failed": 0}
+                for batch in batches
+            ]
+            self.batches_in_flight[source_folder] = 0
+
+            # Keep up to batch_window copy activities in flight for this folder, starting the next batch as one finishes
+            batch_tasks = []
+            for index, batch in enumerate(batches):
+                await workflow.wait_condition(
+                    lambda: self.draining or (not self.paused and self.batches_in_flight[source_folder] < self.batch_window)
+                )
+                if self.draining:
+                    break
+                self.batches_in_flight[source_folder] += 1
+                batch_tasks.append(asyncio.create_task(self.copy_batch(source_folder, index, batch, workflow_id)))
+            await asyncio.gather(*batch_tasks)
+
+            if self.draining:
+                # Files not copied yet are found again by the next run's rescan, failed ones are in the carried over ledger
+                self.defer_folder(source_folder)
+                return
+
+            await self.retry_failed_files(source_folder)
+            if self.verify_copies:
+                await self.verify_folder(source_folder, files_to_update)
+
+            self.folder_progress[source_folder]["stage"] = "done"
+            print(f"Finished processing all {self.files_copied.get(source_folder, 0)} files from {source_folder}")
+        else:
+            # Ledger rows carried over from an earlier run can still be waiting for their retry
+            await self.retry_failed_files(source_folder)
+            self.folder_progress[source_folder]["stage"] = "done"
+            print(f"No files to update in {source_folder}")
+
+    def plan_batches(self, files_to_update: List[Tuple[str, List[str], int]]) -> List[list]:
+        # Largest first balances the batch window best, unless the scan put the files in disk order
+        plan = plan_copy_batches if self.read_order == "walk" else plan_ordered_batches
+        return plan(files_to_update, self.batch_bytes, self.batch_files, self.per_file_overhead_bytes)
+
+    async def copy_batch(self, source_folder: str, index: int, batch: List[Tuple[str, List[str], int]], workflow_id: str):
+        batch_result = self.batch_results[source_folder][index]
+        try:
+            while batch:
+                batch_result["status"] = "running"
+                copied = None
+                if self.is_small_batch(batch) and self.runs_anywhere(source_folder) and not self.is_throttled(("bytes_per_second", "files_per_second")):
+                    copied = await self.copy_locally(source_folder, batch, workflow_id)
+                if copied is not None:
+                    result, files_processed, failures = copied
+                elif self.uses_process_pool():
+                    result, files_processed, failures, digests, _ = await self.execute_copy_activity(
+                        copy_files_sync_activity,
+                        source_folder,
+                        args=[batch, source_folder],
+                        start_to_close_timeout=self.copy_timeout(batch),
+                        heartbeat_timeout=timedelta(seconds=30),
+                    )
+                    if self.verify_copies:
+                        self.copy_digests.setdefault(source_folder, {}).update(digests)
+                else:
+                    result, files_processed, failures = await self.execute_copy_activity(
+                        copy_files_activity,
+                        source_folder,
+                        args=[batch, source_folder, workflow_id, self.rate_limits, self.io_options],
+                        start_to_close_timeout=self.copy_timeout(batch),
+                        heartbeat_timeout=timedelta(seconds=30),
+                    )
+                self.record_copy_result(source_folder, batch[:files_processed], failures)
+                batch_result["copied"] += sum(len(backup_files) for _, backup_files, _ in batch[:files_processed]) - len(failures)
+                batch_result["failed"] += len(failures)
+                batch = batch[files_processed:]
+                if result == "PAUSE":
+                    # Resume with what is left of this batch
+                    batch_result["status"] = "paused"
+                    self.paused = True
+                    await workflow.wait_condition(lambda: not self.paused or self.draining)
+                    if self.draining:
+                        batch_result["status"] = "deferred"
+                        return
+            batch_result["status"] = "done"
+        finally:
+            self.batches_in_flight[source_folder] -= 1
+
+    def copy_timeout(self, batch: List[Tuple[str, List[str], int]], verify: bool = False) -> timedelta:
+        if verify:
+            # Verification isn't throttled and reads the source and every backup
+            read_bytes = sum(size * (1 + len(backup_files)) for _, backup_files, size in batch)
+            return COPY_TIMEOUT_BASE + timedelta(seconds=read_bytes / MIN_COPY_BYTES_PER_SECOND)
+        bytes_per_second = min(self.rate_limits.get("bytes_per_second") or MIN_COPY_BYTES_PER_SECOND, MIN_COPY_BYTES_PER_SECOND)
+        seconds = sum(size for _, _, size in batch) / bytes_per_second
+        if self.rate_limits.get("files_per_second"):
+            seconds += len(batch) / self.rate_limits["files_per_second"]
+        return COPY_TIMEOUT_BASE + timedelta(seconds=seconds)
+
+    async def copy_locally(self, source_folder: str, batch: List[Tuple[str, List[str], int]], workflow_id: str):
+        # Local copies have no heartbeat and a short timeout, a batch they can't finish goes to a regular activity
+        try:
+            return await self.execute_copy_activity(
+                copy_files_activity,
+                source_folder,
+                local=True,
+                args=[batch, source_folder, workflow_id, self.rate_limits, self.io_options],
+                start_to_close_timeout=timedelta(minutes=1),
+                retry_policy=RetryPolicy(maximum_attempts=LOCAL_ACTIVITY_ATTEMPTS),
+            )
+        except ActivityError as e:
+            print(f"Local copy of a batch from {source_folder} failed ({e.cause or e}), copying it with a regular activity")
+            return None
+
+    def uses_process_pool(self) -> bool:
+        # Process pool copies can't be throttled, throttled jobs stay on the async activity
+        return self.copy_mode == "process" and not self.is_throttled(("bytes_per_second", "files_per_second"))
+
+    def is_small_batch(self, batch: List[Tuple[str, List[str], int]]) -> bool:
+        return len(batch) <= self.local_copy_max_files and sum(size for _, _, size in batch) <= self.local_copy_max_bytes
+
+    async def execute_copy_activity(self, activity_fn, source_folder: str, local: bool = False, **kwargs):
+        # Copy activities from all folders share the max_concurrent_copies slots
+        await workflow.wait_condition(
+            lambda: self.max_concurrent_copies is None or self.active_copies < self.max_concurrent_copies
+        )
+        self.active_copies += 1
+        try:
+            if local:
+                return await workflow.execute_local_activity(activity_fn, **kwargs)
+            return await workflow.execute_activity(activity_fn, task_queue=self.task_queue_for(COPY_TASK_QUEUE, source_folder), **kwargs)
+        finally:
+            self.active_copies -= 1
+            self.check_history()
+
+    def is_auto_approved(self, files_to_update: List[Tuple[str, List[str], int]]) -> bool:
+        policy = self.auto_approve
+        if policy is True:
+            return True
+        if not policy:
+            return False
+        if policy.get("max_files") is not None and len(files_to_update) > policy["max_files"]:
+            return False
+        if policy.get("max_bytes") is not None and sum(size for _, _, size in files_to_update) > policy["max_bytes"]:
+            return False
+        return True
+
+    async def wait_for_approval(self, source_folder: str, files_to_update: List[Tuple[str, List[str], int]]):
+        # True or False once decided, None if the run has to continue as new first
+        if self.is_auto_approved(files_to_update):
+            return True
+        self.pending_approval[source_folder] = {
+            "files": len(files_to_update),
+            "bytes": sum(size for _, _, size in files_to_update),
+        }
+        await self.report_pending_approval(source_folder)
+        await workflow.wait_condition(lambda: self.approval_for(source_folder) is not None or self.draining)
+        del self.pending_approval[source_folder]
+        await self.report_pending_approval(source_folder)
+        return self.approval_for(source_folder)
+
+    def approval_for(self, source_folder: str):
+        return self.approvals.get(source_folder, self.approvals.get("*"))
+
+    def destination_of(self, backup_file: str) -> str:
+        for destination in self.destinations:
+            if backup_file.startswith(destination.rstrip("/") + "/"):
+                return destination
+
+    def count_copied(self, source_folder: str, backup_files: List[str], step: int = 1):
+        self.files_copied[source_folder] = self.files_copied.get(source_folder, 0) + step * len(backup_files)
+        for backup_file in backup_files:
+            self.destination_copied[self.destination_of(backup_file)] += step
+
+    def record_copy_result(self, source_folder: str, processed: List[Tuple[str, List[str], int]], failures: List[list]):
+        failed = {backup_file for _, backup_file, _, _ in failures}
+        self.count_copied(source_folder, [backup_file for _, backup_files, _ in processed for backup_file in backup_files if backup_file not in failed])
+        self.failed_files.setdefault(source_folder, []).extend(failures)
+
+    async def verify_folder(self, source_folder: str, files_to_update: List[Tuple[str, List[str], int]]):
+        # Re-hashes every copied file against its source on the verify pool, backups that differ go
+        # back into the failure ledger and through the targeted retries. Sources the process pool copy
+        # already hashed aren't read again.
+        digests = self.copy_digests.pop(source_folder, {})
+        failed = {backup_file for _, backup_file, _, _ in self.failed_files.get(source_folder, [])}
+        copied = [(source_file, [backup_file for backup_file in backup_files if backup_file not in failed], size)
+                  for source_file, backup_files, size in files_to_update]
+        copied = [entry for entry in copied if entry[1]]
+        if not copied:
+            return
+        self.folder_progress[source_folder]["stage"] = "verifying"
+        batches = self.plan_batches(copied)
+        results = await asyncio.gather(*[
+            workflow.execute_activity(
+                verify_files_activity,
+                args=[batch, {source_file: digests[source_file] for source_file, _, _ in batch if source_file in digests}],
+                task_queue=self.task_queue_for(VERIFY_TASK_QUEUE, source_folder),
+                start_to_close_timeout=self.copy_timeout(batch, verify=True),
+                heartbeat_timeout=timedelta(seconds=30),
+            )
+            for batch in batches
+        ])
+        self.check_history()
+        mismatches = [row for rows, _ in results for row in rows]
+        self.folder_progress[source_folder]["verified"] = sum(len(backup_files) for _, backup_files, _ in copied) - len(mismatches)
+        if mismatches:
+            print(f"{len(mismatches)} backups of {source_folder} don't match their source, copying them again")
+            self.count_copied(source_folder, [backup_file for _, backup_file, _, _ in mismatches], -1)
+            self.failed_files.setdefault(source_folder, []).extend(mismatches)
+            await self.retry_failed_files(source_folder)
+
+    async def retry_failed_files(self, source_folder: str):
+        backoff = FAILED_FILE_RETRY_BACKOFF
+        for _ in range(FAILED_FILE_RETRY_ROUNDS):
+            failures = self.failed_files.get(source_folder)
+            if not failures:
+                return
+            self.folder_progress[source_folder]["stage"] = "retrying failed files"
+            await asyncio.sleep(backoff.total_seconds())
+            still_failing = await self.execute_copy_activity(
+                retry_failed_files_activity,
+                source_folder,
+                args=[failures, source_folder, self.rate_limits, self.io_options],
+                start_to_close_timeout=RETRY_COPY_TIMEOUT,
+                heartbeat_timeout=timedelta(seconds=30),
+                retry_policy=RetryPolicy(
+                    initial_interval=timedelta(seconds=5),
+                    backoff_coefficient=2.0,
+                    maximum_attempts=3,
+                ),
+            )
+            still_failed = {backup_file for _, backup_file, _, _ in still_failing}
+            self.count_copied(source_folder, [backup_file for _, backup_file, _, _ in failures if backup_file not in still_failed])
+            self.failed_files[source_folder] = still_failing
+            backoff *= 2
+        if self.failed_files.get(source_folder):
+            print(f"{len(self.failed_files[source_folder])} files from {source_folder} could not be copied")
+
+    @workflow.signal
+    def pause_backup(self):
+        print("Received signal to pause backup")
+        self.paused = True
+        self.forward_to_children("pause_backup")
+
+    @workflow.signal
+    def resume_backup(self):
+        print("Received signal to resume backup")
+        self.paused = False
+        self.forward_to_children("resume_backup")
+
+    @workflow.signal
+    def request_backup(self, trigger: dict = None):
+        # Sent with signal-with-start for every new trigger of the job. The first one starts the run,
+        # the ones arriving while it runs are folded into a single follow-up pass.
+        print(f"Received backup request {trigger or {}}")
+        self.pending_triggers += 1
+        self.last_trigger = trigger
+
+    @workflow.update
+    def set_paused(self, paused: bool) -> dict:
+        # pause_backup / resume_backup acknowledged with the state now in effect
+        self.pause_backup() if paused else self.resume_backup()
+        return {"paused": self.paused, "children": len(self.children)}
+
+    @workflow.signal
+    def approve_folders(self, folders: List[str]):
+        # One signal can cover many folders, "*" approves every folder still waiting
+        print(f"Received approval for {folders}")
+        for folder in folders:
+            self.approvals[folder] = True
+        self.forward_to_children("approve_folders", folders)
+
+    @workflow.signal
+    def reject_folders(self, folders: List[str]):
+        print(f"Received rejection for {folders}")
+        for folder in folders:
+            self.approvals[folder] = False
+        self.forward_to_children("reject_folders", folders)
+
+    @workflow.signal
+    def child_approval_pending(self, source_folder: str, summary: Optional[dict]):
+        # From a child workflow, summary is None once its folder no longer waits for approval
+        if summary is None:
+            self.pending_approval.pop(source_folder, None)
+        else:
+            self.pending_approval[source_folder] = summary
+
+    @workflow.update
+    def review_folders(self, decisions: dict) -> dict:
+        # {folder or "*": True/False}, acknowledged with the folders still waiting for approval
+        for folder, approved in decisions.items():
+            self.approvals[folder] = bool(approved)
+        self.forward_to_children("approve_folders", [folder for folder, approved in decisions.items() if approved])
+        self.forward_to_children("reject_folders", [folder for folder, approved in decisions.items() if not approved])
+        return {
+            folder: summary for folder, summary in self.pending_approval.items()
+            if self.approval_for(folder) is None
+        }
+
+    @workflow.signal
+    def set_batch_window(self, batch_window: int):
+        print(f"Received new batch window {batch_window}")
+        self.apply_valid_throttle({"batch_window": batch_window})
+
+    @workflow.signal
+    def set_rate_limits(self, rate_limits: dict):
+        print(f"Received new rate limits {rate_limits}")
+        self.apply_valid_throttle(rate_limits, RATE_LIMIT_KEYS)
+
+    @workflow.signal
+    def set_throttle(self, throttle: dict):
+        print(f"Received new throttle {throttle}")
+        self.apply_valid_throttle(throttle)
+
+    @workflow.update
+    def update_throttle(self, throttle: dict) -> dict:
+        # Same as set_throttle, acknowledged with the settings now in effect
+        self.apply_throttle(throttle)
+        return self.get_throttle()
+
+    @update_throttle.validator
+    def validate_throttle(self, throttle: dict):
+        for key, value in throttle.items():
+            if key not in THROTTLE_KEYS:
+                raise ValueError(f"Unknown throttle setting {key!r}")
+            if value is not None and (not isinstance(value, (int, float)) or value < 0):
+                raise ValueError(f"Throttle setting {key!r} must be a positive number or None")
+            if key in ("batch_window", "max_concurrent_copies") and value is not None and value < 1:
+                # Stopping copies altogether is what pause_backup is for
+                raise ValueError(f"{key} must be at least 1")
+
+    def apply_valid_throttle(self, throttle: dict, keys: Tuple[str, ...] = THROTTLE_KEYS):
+        # Signals can't be rejected like the update, settings it would reject are dropped as a whole
+        try:
+            unknown = [key for key in throttle if key not in keys]
+            if unknown:
+                raise ValueError(f"Unknown settings {unknown}")
+            self.validate_throttle(throttle)
+        except ValueError as e:
+            print(f"Ignoring throttle {throttle}: {e}")
+            return
+        self.apply_throttle(throttle)
+
+    def apply_throttle(self, throttle: dict):
+        # Concurrency and window apply to the next dispatch, rate limits reach running copies on their next poll
+        if "max_concurrent_copies" in throttle:
+            self.max_concurrent_copies = throttle["max_concurrent_copies"]
+        if throttle.get("batch_window"):
+            self.batch_window = max(1, int(throttle["batch_window"]))
+        self.rate_limits.update({key: value for key, value in throttle.items() if key in RATE_LIMIT_KEYS})
+        shared = RATE_LIMIT_KEYS + ("max_concurrent_copies",)
+        if any(key not in shared for key in throttle):
+            self.forward_to_children("set_throttle", {key: value for key, value in throttle.items() if key not in shared})
+        if any(key in shared for key in throttle):
+            self.share_throttle()
+
+
+@workflow.defn
+class FolderBackupWorkflow(FileBackupWorkflow):
+    # Child workflow backing up a single source folder, with the same signals and queries as the parent
+    @workflow.run
+    async def run(self, source_folders: List[str], backup_folder: Union[str, List[str]], workflow_id: str, options: dict = None,
+                  carry_over: dict = None) -> dict:
+        return await super().run(source_folders, backup_folder, workflow_id, options, carry_over)
@@ -0,0 +1,76 @@
+import fcntl
+import json
+import os
+import socket
+from typing import Dict, List, Optional
+
+
+# Which host owns which local paths, as {host: [root, ...]}. Like the blob store, the client and
+# every worker must see the same file (a shared mount), workers add their roots to it on start.
+HOST_REGISTRY_FILE = os.environ.get("FILE_BACKUP_HOST_REGISTRY", os.path.expanduser("~/.file_backup/hosts.json"))
+
+
+def host_name() -> str:
+    return os.environ.get("FILE_BACKUP_HOST") or socket.gethostname()
+
+
+def host_task_queue(task_queue: str, host: Optional[str]) -> str:
+    # Activities of a folder owned by a host go to that host's copy of the queue, the rest to the shared one
+    return f"{task_queue}@{host}" if host else task_queue
+
+
+def load_hosts(path: str = HOST_REGISTRY_FILE) -> Dict[str, List[str]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def blob_marker(blob_dir: str, host: str) -> str:
+    # Blobs live in two character subdirectories, so this can't collide with one
+    return os.path.join(blob_dir, ".hosts", host)
+
+
+def register_host(host: str, roots: List[str], path: str = HOST_REGISTRY_FILE, blob_dir: Optional[str] = None):
+    # Replaces the host's roots. The lock file keeps hosts registering at the same moment from
+    # overwriting each other's entries. With blob_dir the host also leaves a marker in its blob store,
+    # so resolve_hosts can tell whether the client shares it.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        hosts = load_hosts(path)
+        hosts[host] = [os.path.abspath(root) for root in roots]
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(hosts, f, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
+    if blob_dir:
+        os.makedirs(os.path.dirname(blob_marker(blob_dir, host)), exist_ok=True)
+        open(blob_marker(blob_dir, host), "w").close()
+
+
+def owner_of(folder: str, hosts: Dict[str, List[str]]) -> Optional[str]:
+    # The host with the longest root containing the folder, None if no host claims it
+    folder = os.path.abspath(folder)
+    best_host, best_root = None, ""
+    for host, roots in hosts.items():
+        for root in roots:
+            if (folder == root or folder.startswith(root.rstrip("/") + "/")) and len(root) > len(best_root):
+                best_host, best_root = host, root
+    return best_host
+
+
+def resolve_hosts(folders: List[str], path: str = HOST_REGISTRY_FILE, blob_dir: Optional[str] = None) -> Dict[str, str]:
+    # {folder: host} for the folders some host owns. With blob_dir, fails unless every owning host left
+    # its marker in that blob store: workflows handing work to a host with its own store would never
+    # find the file lists it stored.
+    hosts = load_hosts(path)
+    owners = {folder: owner_of(folder, hosts) for folder in folders}
+    folder_hosts = {folder: host for folder, host in owners.items() if host}
+    if blob_dir:
+        unshared = sorted({host for host in folder_hosts.values() if not os.path.exists(blob_marker(blob_dir, host))})
+        if unshared:
+            raise ValueError(f"Hosts {', '.join(unshared)} don't share the blob store {blob_dir}, "
+                             f"point FILE_BACKUP_BLOB_DIR at the same shared mount on every host")
+    return folder_hosts
@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import os
+import zlib
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+from temporalio.api.common.v1 import Payload
+from temporalio.converter import PayloadCodec
+
+
+# Payloads bigger than this are stored as blobs and replaced by a reference in history
+CLAIM_CHECK_THRESHOLD_BYTES = 128 * 1024
+
+# Decoded payloads kept in memory, so replays don't read the same blobs from disk again
+CLAIM_CHECK_CACHE_BYTES = 256 * 1024 * 1024
+
+CLAIM_CHECK_ENCODING = b"binary/claim-check"
+
+# Payloads bigger than this are zlib compressed, the repetitive path lists shrink by an order of magnitude
+COMPRESSION_THRESHOLD_BYTES = 4 * 1024
+
+COMPRESSION_ENCODING = b"binary/zlib"
+
+
+class CompressionCodec(PayloadCodec):
+    # The encoding metadata marks compressed payloads, so histories mixing compressed and plain payloads decode fine
+    def __init__(self, threshold_bytes: int = COMPRESSION_THRESHOLD_BYTES, level: int = 6):
+        self.threshold_bytes = threshold_bytes
+        self.level = level
+
+    async def encode(self, payloads: Sequence[Payload]) -> List[Payload]:
+        encoded = []
+        for payload in payloads:
+            data = payload.SerializeToString()
+            compressed = zlib.compress(data, self.level) if len(data) > self.threshold_bytes else None
+            if compressed is None or len(compressed) >= len(data):
+                encoded.append(payload)
+                continue
+            encoded.append(Payload(metadata={"encoding": COMPRESSION_ENCODING}, data=compressed))
+        return encoded
+
+    async def decode(self, payloads: Sequence[Payload]) -> List[Payload]:
+        return [
+            Payload.FromString(zlib.decompress(payload.data))
+            if payload.metadata.get("encoding") == COMPRESSION_ENCODING else payload
+            for payload in payloads
+        ]
+
+
+class ChainedCodec(PayloadCodec):
+    # Applies codecs in order when encoding and in reverse order when decoding
+    def __init__(self, codecs: Sequence[PayloadCodec]):
+        self.codecs = list(codecs)
+
+    async def encode(self, payloads: Sequence[Payload]) -> List[Payload]:
+        for codec in self.codecs:
+            payloads = await codec.encode(payloads)
+        return list(payloads)
+
+    async def decode(self, payloads: Sequence[Payload]) -> List[Payload]:
+        for codec in reversed(self.codecs):
+            payloads = await codec.decode(payloads)
+        return list(payloads)
+
+
+class ClaimCheckCodec(PayloadCodec):
+    # Offloads large payloads to a content addressed blob store. The directory has to be
+    # reachable at the same path by the client and every worker (local disk or a shared mount).
+    def __init__(self, blob_dir: str, threshold_bytes: int = CLAIM_CHECK_THRESHOLD_BYTES,
+                 cache_bytes: int = CLAIM_CHECK_CACHE_BYTES):
+        self.blob_dir = blob_dir
+        self.threshold_bytes = threshold_bytes
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+
+    def blob_path(self, key: str) -> str:
+        return os.path.join(self.blob_dir, key[:2], key)
+
+    def remember(self, key: str, payload: Payload, size: int):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return
+        self.cache[key] = (payload, size)
+        self.cached_bytes += size
+        while self.cached_bytes > self.cache_bytes and self.cache:
+            _, (_, evicted_size) = self.cache.popitem(last=False)
+            self.cached_bytes -= evicted_size
+
+    def recall(self, key: str) -> Optional[Payload]:
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        self.cache.move_to_end(key)
+        return entry[0]
+
+    def write_blob(self, key: str, data: bytes):
+        path = self.blob_path(key)
+        if os.path.exists(path):
+            # Same content, same key: nothing to write
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def read_blob(self, key: str) -> bytes:
+        with open(self.blob_path(key), "rb") as f:
+            return f.read()
+
+    async def encode(self, payloads: Sequence[Payload]) -> List[Payload]:
+        encoded = []
+        for payload in payloads:
+            data = payload.SerializeToString()
+            if len(data) <= self.threshold_bytes:
+                encoded.append(payload)
+                continue
+            key = hashlib.sha256(data).hexdigest()
+            if key not in self.cache:
+                await asyncio.to_thread(self.write_blob, key, data)
+            self.remember(key, payload, len(data))
+            encoded.append(Payload(metadata={"encoding": CLAIM_CHECK_ENCODING}, data=key.encode()))
+        return encoded
+
+    async def decode(self, payloads: Sequence[Payload]) -> List[Payload]:
+        decoded = []
+        for payload in payloads:
+            if payload.metadata.get("encoding") != CLAIM_CHECK_ENCODING:
+                decoded.append(payload)
+                continue
+            key = payload.data.decode()
+            original = self.recall(key)
+            if original is None:
+                data = await asyncio.to_thread(self.read_blob, key)
+                if hashlib.sha256(data).hexdigest() != key:
+                    raise ValueError(f"Claim check blob {key} is corrupt")
+                original = Payload.FromString(data)
+                self.remember(key, original, len(data))
+            decoded.append(original)
+        return decoded
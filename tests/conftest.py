@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import file_backup_activities  # noqa: E402
+
+
+class FakeWorkflows:
+    # Stands in for the client activities poll their workflow's controls with, there is no Temporal server
+    def __init__(self):
+        self.controls = {"paused": False, "rate_limits": {}}
+        self.queries = []
+
+    def get_workflow_handle(self, workflow_id):
+        return FakeHandle(self, workflow_id)
+
+
+class FakeHandle:
+    def __init__(self, workflows: FakeWorkflows, workflow_id: str):
+        self.workflows = workflows
+        self.id = workflow_id
+
+    async def query(self, name):
+        self.workflows.queries.append(name)
+        return self.workflows.controls
+
+
+@pytest.fixture(autouse=True)
+def workflows(monkeypatch) -> FakeWorkflows:
+    workflows = FakeWorkflows()
+
+    async def activity_client():
+        return workflows
+
+    monkeypatch.setattr(file_backup_activities, "activity_client", activity_client)
+    return workflows
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from backup_cli import load_jobs, workflow_id_for
+from control_plane import workflow_id_for_folders
+
+
+def jobs_file(tmp_path, config: dict) -> str:
+    path = tmp_path / "jobs.json"
+    path.write_text(json.dumps(config))
+    return str(path)
+
+
+def test_load_jobs_merges_defaults_and_picks_jobs(tmp_path):
+    path = jobs_file(tmp_path, {
+        "defaults": {"options": {"auto_approve": True, "io_mode": "cache_neutral"}},
+        "jobs": [
+            {"name": "photos", "sources": ["/data/photos"], "destinations": ["/backup/a"]},
+            {"name": "home", "sources": ["/home/me"], "destinations": ["/backup/a"], "options": {"auto_approve": False}},
+        ],
+    })
+    assert [job["name"] for job in load_jobs(path)] == ["photos", "home"]
+    (home,) = load_jobs(path, ["home"])
+    assert home["options"] == {"auto_approve": False, "io_mode": "cache_neutral"}
+    with pytest.raises(ValueError, match="Unknown jobs: music"):
+        load_jobs(path, ["music"])
+
+
+@pytest.mark.parametrize("jobs, error", [
+    ([{"name": "a", "sources": ["/s"]}], "has no destinations"),
+    ([{"name": "a", "sources": ["/s"], "destinations": ["/d"], "on_conflict": "merge"}], "unknown on_conflict"),
+    ([{"name": "a", "sources": ["/s"], "destinations": ["/d"]}, {"name": "a", "sources": ["/t"], "destinations": ["/d"]}], "defined twice"),
+    ([{"name": "a", "sources": ["/s", "/t"], "destinations": ["/d"]}, {"name": "b", "sources": ["/t", "/s"], "destinations": ["/d"]}], "same folders"),
+])
+def test_load_jobs_rejects_bad_jobs(tmp_path, jobs, error):
+    with pytest.raises(ValueError, match=error):
+        load_jobs(jobs_file(tmp_path, {"jobs": jobs}))
+
+
+def test_jobs_and_file_backup3_trigger_the_same_workflow():
+    job = {"name": "photos", "sources": ["/data/b", "/data/a"], "destinations": ["/backup/a"]}
+    assert workflow_id_for(job) == workflow_id_for_folders(["/data/a", "/data/b"], "/backup/a")
+    assert workflow_id_for(job) != workflow_id_for(dict(job, destinations=["/backup/b"]))
@@ -0,0 +1,41 @@
+import asyncio
+import builtins
+
+import pytest
+
+from control_plane import WORKFLOW_ID_PREFIX, console, parse_command, workflow_id_for_folders
+
+
+def test_the_same_folders_map_to_the_same_workflow():
+    workflow_id = workflow_id_for_folders(["/data/a", "/data/b"], "/backup")
+    assert workflow_id.startswith(WORKFLOW_ID_PREFIX)
+    assert workflow_id_for_folders(["/data/b", "/data/a"], ["/backup"]) == workflow_id
+    assert workflow_id_for_folders(["/data/a"], "/backup") != workflow_id
+    assert workflow_id_for_folders(["/data/a", "/data/b"], ["/backup", "/offsite"]) != workflow_id
+
+
+@pytest.mark.parametrize("line, parsed", [
+    ("pause", ("pause", [], [])),
+    ("Status @all @host:nas", ("status", [], ["all", "host:nas"])),
+    ("approve /data/a @file-backup-1", ("review", [{"/data/a": True}], ["file-backup-1"])),
+    ("approve all", ("review", [{"*": True}], [])),
+    ("reject", ("review", [{"*": False}], [])),
+    ("throttle bytes_per_second=2e7 batch_window=2 max_concurrent_copies=none",
+     ("throttle", [{"bytes_per_second": 2e7, "batch_window": 2.0, "max_concurrent_copies": None}], [])),
+    ("@all", (None, [], ["all"])),
+])
+def test_parse_command(line, parsed):
+    assert parse_command(line) == parsed
+
+
+def test_parse_command_rejects_bad_throttle_values():
+    with pytest.raises(ValueError):
+        parse_command("throttle bytes_per_second=fast")
+
+
+def test_console_ends_when_stdin_is_closed(monkeypatch):
+    def closed(prompt):
+        raise EOFError
+
+    monkeypatch.setattr(builtins, "input", closed)
+    asyncio.run(asyncio.wait_for(console(None, ["file-backup-1"]), 5))
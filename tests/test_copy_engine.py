@@ -0,0 +1,120 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from temporalio.testing import ActivityEnvironment
+
+from copy_engine import CHUNK_SIZE, PARTIAL_SUFFIX, BackupWriter, TokenBucket, copy_file, copy_file_parallel, copy_file_to_many, tree_hash
+from file_backup_activities import list_files_activity
+
+
+def test_token_bucket_paces_to_rate():
+    async def run():
+        bucket = TokenBucket(20)
+        started = time.monotonic()
+        for _ in range(30):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # 20 tokens of burst, the other 10 take about half a second
+    assert 0.4 < asyncio.run(run()) < 1.5
+
+
+def test_rate_increase_reaches_waiting_acquirers():
+    async def run():
+        bucket = TokenBucket(1)
+        await bucket.acquire()
+        waiters = [asyncio.create_task(bucket.acquire()) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        bucket.set_rate(1000)
+        await asyncio.gather(*waiters)
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) < 0.5
+
+
+def test_large_request_goes_into_debt():
+    async def run():
+        bucket = TokenBucket(10)
+        await bucket.acquire(25)
+        return bucket.tokens
+
+    assert asyncio.run(run()) < 0
+
+
+def test_copies_keep_the_event_loop_free(tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    source.write_bytes(os.urandom(3 * CHUNK_SIZE))
+    original_write = BackupWriter.write
+
+    def slow_write(self, chunk):
+        # Stands in for a disk that takes a while, e.g. an fdatasync in cache neutral mode
+        time.sleep(0.1)
+        original_write(self, chunk)
+
+    monkeypatch.setattr(BackupWriter, "write", slow_write)
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await copy_file(str(source), str(tmp_path / "single" / "source"))
+        ticks_during_copy = ticks
+        await copy_file_to_many(str(source), [str(tmp_path / "a" / "source"), str(tmp_path / "b" / "source")])
+        task.cancel()
+        return ticks_during_copy
+
+    # Three 0.1 s writes, the ticker runs throughout unless they block the loop
+    assert asyncio.run(run()) > 15
+    for backup in ("single", "a", "b"):
+        assert (tmp_path / backup / "source").read_bytes() == source.read_bytes()
+
+
+def test_killed_parallel_copy_leaves_no_backup_the_scan_trusts(tmp_path):
+    source, backup = tmp_path / "source", tmp_path / "backup"
+    source.mkdir()
+    data = os.urandom(3 * CHUNK_SIZE)
+    (source / "big").write_bytes(data)
+    backup_file = str(backup / "big")
+
+    def killed(*_):
+        raise SystemExit("worker killed")
+
+    # Dies once the first piece is written, like a worker process that is killed
+    with ThreadPoolExecutor(1) as pool, pytest.raises(SystemExit):
+        copy_file_parallel(str(source / "big"), [backup_file], pool, chunk_bytes=CHUNK_SIZE, on_chunk=killed)
+    assert not os.path.exists(backup_file)
+    files = asyncio.run(ActivityEnvironment().run(list_files_activity, str(source), str(backup)))
+    assert files == [(str(source / "big"), [backup_file], len(data))]
+
+    with ThreadPoolExecutor(2) as pool:
+        digest, failures = copy_file_parallel(str(source / "big"), [backup_file], pool, chunk_bytes=CHUNK_SIZE)
+    assert digest and failures == {}
+    assert open(backup_file, "rb").read() == data
+    assert not os.path.exists(backup_file + PARTIAL_SUFFIX)
+
+
+def test_tree_hash_is_the_same_for_any_thread_count(tmp_path):
+    path = tmp_path / "data"
+    path.write_bytes(os.urandom(5 * CHUNK_SIZE + 123))
+    digests = set()
+    for threads in (1, 3, 8):
+        with ThreadPoolExecutor(threads) as pool:
+            digests.add(tree_hash(str(path), pool, chunk_bytes=CHUNK_SIZE))
+            digest, failures = copy_file_parallel(str(path), [str(tmp_path / f"copy{threads}")], pool, chunk_bytes=CHUNK_SIZE)
+            assert failures == {}
+            digests.add(digest)
+            digests.add(tree_hash(str(tmp_path / f"copy{threads}"), pool, chunk_bytes=CHUNK_SIZE))
+    assert len(digests) == 1
+    (tmp_path / "copy1").write_bytes(os.urandom(5 * CHUNK_SIZE + 123))
+    with ThreadPoolExecutor(2) as pool:
+        assert tree_hash(str(tmp_path / "copy1"), pool, chunk_bytes=CHUNK_SIZE) not in digests
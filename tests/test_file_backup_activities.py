@@ -0,0 +1,223 @@
+import asyncio
+import dataclasses
+import os
+import subprocess
+import sys
+
+import pytest
+from temporalio.testing import ActivityEnvironment
+from temporalio.worker import ExecuteActivityInput
+
+import copy_engine
+from copy_engine import CHUNK_SIZE
+import file_backup_activities
+from file_backup_activities import copy_files_activity, list_files_activity
+
+
+def write(path, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_limiters_are_dropped_once_activities_finish(tmp_path):
+    source, backup = str(tmp_path / "source"), str(tmp_path / "backup")
+    write(os.path.join(source, "a"), b"a" * 10)
+    env = ActivityEnvironment()
+    files = asyncio.run(env.run(list_files_activity, source, backup, {"scan_files_per_second": 100}))
+    result = asyncio.run(env.run(copy_files_activity, files, source, "job", {"bytes_per_second": 10_000}))
+    assert result[0] == "SUCCESS"
+    assert copy_engine._limiters == {} and copy_engine._limiter_users == {}
+
+
+def test_a_cut_off_copy_continues_from_its_last_heartbeat(tmp_path):
+    source, backup = str(tmp_path / "source"), str(tmp_path / "backup")
+    data = os.urandom(8 * CHUNK_SIZE)
+    write(os.path.join(source, "big"), data)
+    files = [(os.path.join(source, "big"), [os.path.join(backup, "big")], len(data))]
+
+    # The first attempt is lost after a few chunks, like one that hit its start-to-close timeout
+    first = ActivityEnvironment()
+    heartbeats = []
+
+    def on_heartbeat(*details):
+        heartbeats.append(details[0])
+        if details[0].get("partial") and details[0]["partial"]["offset"] >= 3 * CHUNK_SIZE:
+            first.cancel()
+
+    first.on_heartbeat = on_heartbeat
+    # The cancel lands in the copy's next await, the attempt ends cancelled rather than failed
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(first.run(copy_files_activity, files, source, "job"))
+    checkpoint = heartbeats[-1]
+    assert checkpoint["partial"]["offset"] >= 3 * CHUNK_SIZE
+
+    second = ActivityEnvironment()
+    second.info = dataclasses.replace(second.info, heartbeat_details=[checkpoint])
+    bytes_read = file_backup_activities.worker_metrics["bytes_read"]
+    assert asyncio.run(second.run(copy_files_activity, files, source, "job"))[:2] == ("SUCCESS", 1)
+    assert file_backup_activities.worker_metrics["bytes_read"] - bytes_read == len(data) - checkpoint["partial"]["offset"]
+    with open(os.path.join(backup, "big"), "rb") as f:
+        assert f.read() == data
+
+
+def test_scan_flags_backups_of_another_size(tmp_path):
+    source, backup = str(tmp_path / "source"), str(tmp_path / "backup")
+    write(os.path.join(source, "same"), b"s" * 10)
+    write(os.path.join(source, "cut"), b"c" * 10)
+    # Written after the sources, like every copy, one of them cut off half way
+    write(os.path.join(backup, "same"), b"s" * 10)
+    write(os.path.join(backup, "cut"), b"c" * 5)
+    files = asyncio.run(ActivityEnvironment().run(list_files_activity, source, backup))
+    assert [os.path.basename(source_file) for source_file, _, _ in files] == ["cut"]
+
+
+def test_copies_of_one_job_share_one_control_poller(tmp_path, workflows):
+    source, backup = str(tmp_path / "source"), str(tmp_path / "backup")
+    batches = []
+    for name in ("a", "b", "c"):
+        write(os.path.join(source, name), os.urandom(4 * CHUNK_SIZE))
+        batches.append([(os.path.join(source, name), [os.path.join(backup, name)], 4 * CHUNK_SIZE)])
+
+    async def copy_all():
+        return await asyncio.gather(*[ActivityEnvironment().run(copy_files_activity, batch, source, "job")
+                                      for batch in batches])
+
+    assert [result[0] for result in asyncio.run(copy_all())] == ["SUCCESS"] * 3
+    assert workflows.queries == ["get_controls"]
+    assert file_backup_activities._controls == {}
+
+
+def test_control_poll_failures_are_logged_and_backed_off(monkeypatch, caplog):
+    class FailingHandle:
+        id = "job"
+
+        async def query(self, name):
+            raise RuntimeError("workflow not found")
+
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        if len(delays) == 6:
+            raise asyncio.CancelledError
+
+    monkeypatch.setattr(file_backup_activities.asyncio, "sleep", fake_sleep)
+    controls = file_backup_activities.WorkflowControls(FailingHandle(), None)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(controls.watch())
+    assert delays == [10, 20, 40, 60, 60, 60]
+    assert "workflow not found" in caplog.text
+
+
+def test_resume_point_only_continues_unchanged_files(tmp_path):
+    source, backup = str(tmp_path / "source"), str(tmp_path / "backup")
+    write(source, b"s" * 100)
+    write(backup, b"s" * 40)
+    partial = file_backup_activities.partial_checkpoint(source, [backup], 40)
+    resume_point = file_backup_activities.resume_point
+    assert resume_point(partial, source) == ([backup], 40)
+    assert resume_point(None, source) is None
+    assert resume_point(partial, str(tmp_path / "other")) is None
+    # A backup shorter than the checkpoint lost data, a changed source has to be copied over
+    assert resume_point(dict(partial, offset=60), source) is None
+    write(source, b"t" * 120)
+    assert resume_point(partial, source) is None
+
+
+def test_workers_split_the_cores_between_them():
+    code = "import os, file_backup_activities as a; print(a.CORES_PER_WORKER, a.PIECE_THREADS, os.cpu_count())"
+    env = dict(os.environ, FILE_BACKUP_WORKER_PROCESSES="4")
+    output = subprocess.run([sys.executable, "-c", code], env=env, cwd=os.path.dirname(os.path.dirname(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    cores_per_worker, piece_threads, cpu_count = map(int, output.split())
+    assert cores_per_worker == piece_threads == max(1, cpu_count // 4)
+
+
+def test_process_pool_counts_reach_the_worker_metrics(tmp_path):
+    source, backup = str(tmp_path / "source"), str(tmp_path / "backup")
+    write(os.path.join(source, "a"), b"a" * 100)
+    files = [(os.path.join(source, "a"), [os.path.join(backup, "a")], 100)]
+    result = ActivityEnvironment().run(file_backup_activities.copy_files_sync_activity, files, source)
+    assert result[:3] == ("SUCCESS", 1, []) and result[-1] == {"files_copied": 1, "bytes_read": 100, "copy_failures": 0}
+
+    class Next:
+        async def execute_activity(self, input):
+            return input.fn(*input.args)
+
+    # The interceptor runs in the worker process, the activity itself would run in the pool
+    interceptor = file_backup_activities.WorkerMetricsInterceptor().intercept_activity(Next())
+    verify = ExecuteActivityInput(fn=file_backup_activities.verify_files_activity, args=[files], executor=None, headers={})
+    before = dict(file_backup_activities.worker_metrics)
+    mismatches, _ = ActivityEnvironment().run(lambda: asyncio.run(interceptor.execute_activity(verify)))
+    assert mismatches == []
+    assert file_backup_activities.worker_metrics["files_verified"] == before.get("files_verified", 0) + 1
+
+
+def test_verify_finds_backups_that_differ_and_trusts_copy_digests(tmp_path):
+    source, backup = str(tmp_path / "source"), str(tmp_path / "backup")
+    for name in ("good", "bad"):
+        write(os.path.join(source, name), os.urandom(1000))
+    files = [(os.path.join(source, name), [os.path.join(backup, name)], 1000) for name in ("good", "bad")]
+    env = ActivityEnvironment()
+    _, _, failures, digests, _ = env.run(file_backup_activities.copy_files_sync_activity, files, source)
+    assert failures == [] and sorted(digests) == sorted(source_file for source_file, _, _ in files)
+
+    write(os.path.join(backup, "bad"), os.urandom(1000))
+    mismatches, metrics = env.run(file_backup_activities.verify_files_activity, files)
+    assert [row[:2] for row in mismatches] == [[os.path.join(source, "bad"), os.path.join(backup, "bad")]]
+    assert metrics == {"files_verified": 2}
+
+    # With the copy's digests the sources aren't read again, a source changed since doesn't matter
+    write(os.path.join(source, "good"), os.urandom(1000))
+    mismatches, _ = env.run(file_backup_activities.verify_files_activity, files[:1], digests)
+    assert mismatches == []
+    assert env.run(file_backup_activities.verify_files_activity, files[:1])[0] != []
+
+
+def test_scans_keep_the_event_loop_free(tmp_path):
+    source = tmp_path / "source"
+    for part in range(4):
+        (source / str(part)).mkdir(parents=True)
+        for index in range(1000):
+            (source / str(part) / str(index)).write_bytes(b"x")
+
+    async def scan_with_ticker():
+        ticks = 0
+        done = asyncio.Event()
+
+        async def ticker():
+            nonlocal ticks
+            while not done.is_set():
+                ticks += 1
+                await asyncio.sleep(0)
+
+        task = asyncio.create_task(ticker())
+        files = await ActivityEnvironment().run(list_files_activity, str(source), str(tmp_path / "backup"))
+        done.set()
+        await task
+        return files, ticks
+
+    files, ticks = asyncio.run(scan_with_ticker())
+    assert len(files) == 4000
+    assert ticks > 16
+
+
+def test_running_scans_follow_scan_rate_changes(tmp_path, workflows, monkeypatch):
+    source = str(tmp_path / "source")
+    for index in range(40):
+        write(os.path.join(source, str(index)), b"x")
+    # Set while the scan runs, it started without a scan limit
+    workflows.controls = {"paused": False, "rate_limits": {"scan_files_per_second": 1000}}
+    rates = []
+    outdated_files = file_backup_activities.outdated_files
+
+    def recording(*args):
+        rates.extend(limiter.scan_files.rate for limiter in copy_engine._limiters.values())
+        return outdated_files(*args)
+
+    monkeypatch.setattr(file_backup_activities, "outdated_files", recording)
+    files = asyncio.run(ActivityEnvironment().run(list_files_activity, source, str(tmp_path / "backup")))
+    assert len(files) == 40
+    assert rates and set(rates) == {1000}
+    assert copy_engine._limiters == {} and file_backup_activities._controls == {}
@@ -0,0 +1,181 @@
+from datetime import timedelta
+
+from file_backup_workflow import COPY_TIMEOUT_BASE, FileBackupWorkflow, makespan_report, plan_copy_batches, plan_ordered_batches
+
+GB = 1024 ** 3
+
+
+def test_copy_timeout_covers_a_big_file_at_the_job_rate():
+    backup = FileBackupWorkflow()
+    batch = [("/data/disk.img", ["/backup/disk.img"], 20 * GB)]
+    assert backup.copy_timeout(batch) > timedelta(minutes=30)
+    backup.rate_limits = {"bytes_per_second": 1024 * 1024}
+    assert backup.copy_timeout(batch) >= COPY_TIMEOUT_BASE + timedelta(seconds=20 * 1024)
+
+
+def test_copy_timeout_counts_file_rate_and_verification_reads():
+    backup = FileBackupWorkflow()
+    batch = [(f"/data/{name}", [f"/a/{name}", f"/b/{name}"], 0) for name in range(600)]
+    assert backup.copy_timeout(batch) == COPY_TIMEOUT_BASE
+    backup.rate_limits = {"files_per_second": 1}
+    assert backup.copy_timeout(batch) == COPY_TIMEOUT_BASE + timedelta(seconds=600)
+    big = [("/data/x", ["/a/x", "/b/x"], GB)]
+    assert backup.copy_timeout(big, verify=True) > backup.copy_timeout(big)
+
+
+def deferred_backup() -> FileBackupWorkflow:
+    backup = FileBackupWorkflow()
+    backup.destinations = ["/backup"]
+    backup.destination_copied = {"/backup": 1}
+    backup.folder_progress = {"/data/a": {"stage": "done"}, "/data/b": {"stage": "deferred"}}
+    backup.deferred_folders = {"/data/b"}
+    backup.failed_files = {
+        "/data/a": [["/data/a/x", "/backup/x", 5, 4]],
+        "/data/b": [["/data/b/y", "/backup/y", 28, 1], ["/data/b/z", "/backup/z", 5, 1]],
+    }
+    return backup
+
+
+def test_ledger_of_deferred_folders_is_carried_over():
+    carry_over = deferred_backup().carry_over_state(["/data/a", "/data/b"])
+    assert carry_over["done_folders"] == ["/data/a"]
+    assert len(carry_over["failed_files"]["/data/b"]) == 2
+
+    next_run = FileBackupWorkflow()
+    next_run.destination_copied = {"/backup": 0}
+    assert next_run.restore_carry_over(carry_over) == ["/data/a"]
+    # The rescan found y stale again, so only z is left for the targeted retry
+    next_run.drop_rescanned_failures("/data/b", [("/data/b/y", ["/backup/y"], 10)])
+    assert next_run.failed_files["/data/b"] == [["/data/b/z", "/backup/z", 5, 1]]
+
+
+def test_follow_up_pass_keeps_files_still_failing():
+    backup = deferred_backup()
+    backup.failed_files["/data/c"] = []
+    backup.pending_triggers = 2
+    follow_up = backup.follow_up_state()
+    assert follow_up["done_folders"] == [] and follow_up["follow_up"]
+    assert follow_up["passes"] == 2 and follow_up["pending_triggers"] == 0
+    assert follow_up["failed_files"] == {folder: rows for folder, rows in backup.failed_files.items() if rows}
+
+    next_pass = FileBackupWorkflow()
+    next_pass.destination_copied = {"/backup": 0}
+    next_pass.restore_carry_over(follow_up)
+    assert len(next_pass.failed_files["/data/b"]) == 2 and next_pass.files_copied == {}
+
+
+def test_throttled_jobs_skip_the_local_fast_path():
+    backup = FileBackupWorkflow()
+    backup.copy_mode = "process"
+    assert backup.uses_process_pool() and not backup.is_throttled(("scan_files_per_second",))
+    backup.rate_limits = {"scan_files_per_second": 10, "bytes_per_second": None}
+    assert backup.is_throttled(("scan_files_per_second",))
+    assert not backup.is_throttled(("bytes_per_second", "files_per_second")) and backup.uses_process_pool()
+    backup.rate_limits["bytes_per_second"] = 1000
+    assert not backup.uses_process_pool()
+
+
+def test_throttle_signals_drop_settings_the_update_would_reject():
+    backup = FileBackupWorkflow()
+    for bad in ({"max_concurrent_copies": 0}, {"bytes_per_second": -1}, {"bytes_per_second": "fast"}, {"speed": 1}):
+        backup.set_throttle(bad)
+    backup.set_batch_window(0)
+    backup.set_rate_limits({"max_concurrent_copies": 4})
+    assert backup.get_throttle() == FileBackupWorkflow().get_throttle()
+
+    backup.set_throttle({"max_concurrent_copies": 2, "bytes_per_second": 1000})
+    backup.set_batch_window(8)
+    assert backup.max_concurrent_copies == 2 and backup.batch_window == 8
+    assert backup.rate_limits["bytes_per_second"] == 1000
+
+
+def test_children_split_the_job_rate_limits():
+    backup = FileBackupWorkflow()
+    forwarded = []
+    backup.forward_to_children = lambda signal, *args: forwarded.append((signal, *args))
+    backup.rate_limits = {"bytes_per_second": 90, "files_per_second": None}
+    backup.child_folders = {"/data/a", "/data/b", "/data/c"}
+    assert backup.child_rate_limits() == {"bytes_per_second": 30, "files_per_second": None}
+
+    backup.apply_throttle({"bytes_per_second": 60, "batch_window": 2})
+    assert forwarded == [("set_throttle", {"batch_window": 2}),
+                         ("set_throttle", {"bytes_per_second": 20, "files_per_second": None, "max_concurrent_copies": None})]
+    backup.child_folders.discard("/data/c")
+    backup.share_throttle()
+    assert forwarded[-1] == ("set_throttle", {"bytes_per_second": 30, "files_per_second": None, "max_concurrent_copies": None})
+
+
+def test_children_split_the_job_copy_cap():
+    backup = FileBackupWorkflow()
+    forwarded = []
+    backup.forward_to_children = lambda signal, *args: forwarded.append((signal, *args))
+    backup.child_folders = {"/data/a", "/data/b", "/data/c"}
+    assert backup.child_copy_cap() is None
+
+    backup.apply_throttle({"max_concurrent_copies": 7})
+    assert forwarded == [("set_throttle", {"max_concurrent_copies": 2})]
+    backup.apply_throttle({"max_concurrent_copies": 2})
+    assert forwarded[-1] == ("set_throttle", {"max_concurrent_copies": 1})
+    backup.child_folders = {"/data/a"}
+    backup.share_throttle()
+    assert forwarded[-1] == ("set_throttle", {"max_concurrent_copies": 2})
+
+
+def test_parent_reviews_the_approvals_its_children_wait_for():
+    backup = FileBackupWorkflow()
+    backup.forward_to_children = lambda signal, *args: None
+    backup.child_approval_pending("/data/a", {"files": 3, "bytes": 30})
+    backup.child_approval_pending("/data/b", {"files": 1, "bytes": 10})
+    assert backup.review_folders({"/data/a": True}) == {"/data/b": {"files": 1, "bytes": 10}}
+    backup.child_approval_pending("/data/b", None)
+    assert backup.pending_approvals() == {"/data/a": {"files": 3, "bytes": 30}}
+
+
+def files(*sizes):
+    return [(f"/data/{index}", [f"/backup/{index}"], size) for index, size in enumerate(sizes)]
+
+
+def test_planner_spreads_bytes_and_keeps_scan_order():
+    to_copy = files(10, 90, 20, 80, 30, 70)
+    batches = plan_copy_batches(to_copy, batch_bytes=100, batch_files=10, per_file_overhead_bytes=0)
+    assert sorted(entry for batch in batches for entry in batch) == sorted(to_copy)
+    assert [sum(size for _, _, size in batch) for batch in batches] == [100, 100, 100]
+    for batch in batches:
+        assert batch == sorted(batch, key=to_copy.index)
+
+
+def test_planner_gives_big_files_their_own_batch_and_caps_file_counts():
+    batches = plan_copy_batches(files(500, *[1] * 7), batch_bytes=100, batch_files=3, per_file_overhead_bytes=0)
+    assert batches[0] == files(500)
+    assert all(len(batch) <= 3 for batch in batches)
+    assert len(batches) == 4
+
+
+def test_makespan_report_compares_against_the_lower_bound():
+    batches = plan_copy_batches(files(60, 50, 40, 30, 20), batch_bytes=100, batch_files=10, per_file_overhead_bytes=0)
+    report = makespan_report(batches, window=2, per_file_overhead_bytes=0)
+    # Largest first puts 60+30+20 and 50+40 together where 60+40 and 50+30+20 would do
+    assert report == {"batches": 2, "makespan_bytes": 110, "lower_bound_bytes": 100, "ratio": 1.1}
+    assert makespan_report([], window=4, per_file_overhead_bytes=0)["ratio"] == 1.0
+
+
+def test_disk_ordered_files_stay_in_contiguous_batches():
+    to_copy = files(*[10 + index % 7 for index in range(40)])
+    batches = plan_ordered_batches(to_copy, batch_bytes=100, batch_files=10, per_file_overhead_bytes=0)
+    assert [entry for batch in batches for entry in batch] == to_copy
+    loads = [sum(size for _, _, size in batch) for batch in batches]
+    assert len(batches) == 6 and max(loads) - min(loads) <= 30
+
+    backup = FileBackupWorkflow()
+    backup.read_order = "inode"
+    assert backup.plan_batches(to_copy) == plan_ordered_batches(to_copy, backup.batch_bytes, backup.batch_files, backup.per_file_overhead_bytes)
+    backup.read_order = "walk"
+    assert backup.plan_batches(to_copy) == plan_copy_batches(to_copy, backup.batch_bytes, backup.batch_files, backup.per_file_overhead_bytes)
+
+
+def test_ordered_batches_keep_big_files_alone_and_cap_file_counts():
+    batches = plan_ordered_batches(files(1, 1, 500, *[1] * 7), batch_bytes=100, batch_files=3, per_file_overhead_bytes=0)
+    assert [entry for batch in batches for entry in batch] == files(1, 1, 500, *[1] * 7)
+    assert all(len(batch) <= 3 for batch in batches)
+    assert [len(batch) for batch in batches if any(size == 500 for _, _, size in batch)] == [1]
+    assert plan_ordered_batches([], 100, 3, 0) == []
@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from host_registry import load_hosts, owner_of, register_host, resolve_hosts
+
+
+def test_owner_is_the_host_with_the_longest_root():
+    hosts = {"nas": ["/data"], "laptop": ["/data/photos", "/home/me"]}
+    assert owner_of("/data/photos/2024", hosts) == "laptop"
+    assert owner_of("/data/photos", hosts) == "laptop"
+    assert owner_of("/data/photoshop", hosts) == "nas"
+    assert owner_of("/srv", hosts) is None
+
+
+def test_hosts_registering_at_once_keep_every_entry(tmp_path):
+    path = str(tmp_path / "hosts.json")
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda index: register_host(f"host-{index}", [f"/data/{index}"], path), range(32)))
+    assert sorted(load_hosts(path)) == sorted(f"host-{index}" for index in range(32))
+
+
+def test_hosts_have_to_share_the_blob_store(tmp_path):
+    path, blob_dir = str(tmp_path / "hosts.json"), str(tmp_path / "blobs")
+    register_host("nas", ["/data"], path, blob_dir=blob_dir)
+    assert resolve_hosts(["/data/a", "/srv"], path, blob_dir) == {"/data/a": "nas"}
+    register_host("laptop", ["/home/me"], path, blob_dir=str(tmp_path / "laptop-blobs"))
+    with pytest.raises(ValueError, match="laptop don't share the blob store"):
+        resolve_hosts(["/data/a", "/home/me/docs"], path, blob_dir)
@@ -0,0 +1,62 @@
+import asyncio
+import os
+
+import pytest
+from temporalio.api.common.v1 import Payload
+
+from payload_codecs import CLAIM_CHECK_ENCODING, COMPRESSION_ENCODING, ChainedCodec, ClaimCheckCodec, CompressionCodec
+
+
+def payload(data: bytes) -> Payload:
+    return Payload(metadata={"encoding": b"json/plain"}, data=data)
+
+
+def round_trip(codec, payloads):
+    encoded = asyncio.run(codec.encode(payloads))
+    return encoded, asyncio.run(codec.decode(encoded))
+
+
+def test_big_payloads_go_to_the_blob_store(tmp_path):
+    codec = ClaimCheckCodec(str(tmp_path), threshold_bytes=1024)
+    small, big = payload(b"x" * 10), payload(os.urandom(4096))
+    encoded, decoded = round_trip(codec, [small, big])
+    assert encoded[0] == small
+    assert encoded[1].metadata["encoding"] == CLAIM_CHECK_ENCODING
+    assert os.path.exists(codec.blob_path(encoded[1].data.decode()))
+    assert decoded == [small, big]
+
+    # Another process decodes from the blob, and notices if it was changed
+    other = ClaimCheckCodec(str(tmp_path), threshold_bytes=1024)
+    assert asyncio.run(other.decode(encoded)) == [small, big]
+    with open(codec.blob_path(encoded[1].data.decode()), "r+b") as f:
+        f.write(b"corrupt")
+    with pytest.raises(ValueError, match="corrupt"):
+        asyncio.run(ClaimCheckCodec(str(tmp_path)).decode(encoded))
+
+
+def test_claim_check_cache_stays_within_its_budget(tmp_path):
+    codec = ClaimCheckCodec(str(tmp_path), threshold_bytes=1024, cache_bytes=10_000)
+    asyncio.run(codec.encode([payload(os.urandom(4096)) for _ in range(5)]))
+    assert codec.cached_bytes <= 10_000 and len(codec.cache) == 2
+
+
+def test_only_payloads_that_shrink_are_compressed():
+    codec = CompressionCodec(threshold_bytes=1024)
+    paths = payload(b'["/data/photos/2024/IMG_0001.jpg", ' * 200)
+    random, small = payload(os.urandom(4096)), payload(b"[]")
+    encoded, decoded = round_trip(codec, [paths, random, small])
+    assert encoded[0].metadata["encoding"] == COMPRESSION_ENCODING
+    assert len(encoded[0].data) < len(paths.data) / 10
+    assert encoded[1:] == [random, small]
+    assert decoded == [paths, random, small]
+
+
+def test_chained_codec_compresses_before_offloading(tmp_path):
+    claim_check = ClaimCheckCodec(str(tmp_path), threshold_bytes=1024)
+    codec = ChainedCodec([CompressionCodec(threshold_bytes=1024), claim_check])
+    # Compressed below the claim check threshold, so it stays inline
+    paths = payload(b'["/data/photos/2024/IMG_0001.jpg", ' * 200)
+    encoded, decoded = round_trip(codec, [paths])
+    assert encoded[0].metadata["encoding"] == COMPRESSION_ENCODING
+    assert claim_check.cache == {}
+    assert decoded == [paths]
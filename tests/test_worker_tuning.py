@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from temporalio.worker import ResourceBasedSlotSupplier
+
+from worker_tuning import DiskAwareSlotSupplier, build_tuner
+
+
+def idle_supplier(**kwargs) -> DiskAwareSlotSupplier:
+    supplier = DiskAwareSlotSupplier(ramp_throttle=timedelta(0), devices=["none"], **kwargs)
+    supplier.load.sample = lambda: None
+    return supplier
+
+
+def test_slots_stay_within_the_maximum_across_threads():
+    supplier = idle_supplier(maximum_slots=4)
+    most = []
+
+    def take_and_release(_):
+        for _ in range(2000):
+            if supplier.try_reserve_slot(None):
+                most.append(supplier.issued)
+                supplier.release_slot(None)
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(take_and_release, range(8)))
+    assert max(most) <= 4
+    assert supplier.issued == 0
+
+
+def test_busy_disk_holds_back_slots_above_the_minimum():
+    supplier = idle_supplier(minimum_slots=1, max_queue_depth=8)
+    supplier.load.queue_depth = 8
+    assert supplier.try_reserve_slot(None)
+    assert supplier.try_reserve_slot(None) is None
+    supplier.load.queue_depth = 2
+    assert supplier.try_reserve_slot(None)
+
+
+def test_scan_and_copy_pools_get_their_own_suppliers():
+    copy, other_copy, scan = build_tuner("disk", 8), build_tuner("disk", 8), build_tuner("resources", 16)
+    assert isinstance(copy.activity_slot_supplier, DiskAwareSlotSupplier)
+    assert copy.activity_slot_supplier is not other_copy.activity_slot_supplier
+    assert copy.activity_slot_supplier.maximum_slots == 8
+    assert isinstance(scan.activity_slot_supplier, ResourceBasedSlotSupplier)
+    assert scan.activity_slot_supplier.slot_config.maximum_slots == 16
+    for tuner in (copy, scan):
+        # What the worker hands to the SDK core, fails on settings it doesn't accept
+        tuner._to_bridge_tuner()
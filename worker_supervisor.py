@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from collections import Counter
+from typing import List, Optional
+
+
+# Seconds between metric reports from each worker process and between supervisor summaries
+METRICS_INTERVAL_SECONDS = 10
+
+# A worker that dies is restarted after this delay, doubled for every crash in a row up to the cap
+RESTART_BACKOFF_SECONDS = 1
+MAX_RESTART_BACKOFF_SECONDS = 60
+
+# A worker that ran this long before dying is considered healthy again, its backoff starts over
+HEALTHY_RUN_SECONDS = 60
+
+# Extra time on top of the worker's own drain timeout before a stopping worker is killed
+KILL_GRACE_SECONDS = 15
+
+
+def worker_process(index: int, metrics: multiprocessing.Queue, metrics_interval: float, pools: Optional[List[str]],
+                   roots: Optional[List[str]]):
+    # Runs in a child process: its own event loop, client and Temporal runtime. SIGTERM and
+    # SIGINT stop polling and drain running activities.
+    import file_backup3
+    from file_backup_activities import worker_metrics
+
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+
+        async def report():
+            while True:
+                metrics.put((index, os.getpid(), dict(worker_metrics)))
+                await asyncio.sleep(metrics_interval)
+
+        reporter = asyncio.create_task(report())
+        try:
+            await file_backup3.run_worker(stop, pools, roots)
+        finally:
+            reporter.cancel()
+            metrics.put((index, os.getpid(), dict(worker_metrics)))
+
+    asyncio.run(serve())
+
+
+class WorkerSupervisor:
+    # Keeps `processes` workers polling the task queue. Every worker has its own GIL, so hashing,
+    # compression and payload encoding spread over the cores instead of sharing one.
+    def __init__(self, processes: int, metrics_interval: float = METRICS_INTERVAL_SECONDS, pools: Optional[List[str]] = None,
+                 roots: Optional[List[str]] = None):
+        # spawn, the Temporal runtime's threads don't survive a fork
+        self.context = multiprocessing.get_context("spawn")
+        self.metrics = self.context.Queue()
+        self.processes = processes
+        self.metrics_interval = metrics_interval
+        self.pools = pools
+        self.roots = roots
+        self.workers = {}
+        self.started_at = {}
+        self.crashes = Counter()
+        self.restart_at = {}
+        self.latest = {}
+        self.retired = Counter()
+        self.restarts = 0
+        self.stopping = False
+
+    def start_worker(self, index: int):
+        process = self.context.Process(target=worker_process, args=(index, self.metrics, self.metrics_interval, self.pools, self.roots),
+                                       name=f"file-backup-worker-{index}")
+        process.start()
+        self.workers[index] = process
+        self.started_at[index] = time.monotonic()
+        print(f"Worker {index} started with pid {process.pid}")
+
+    def collect_metrics(self):
+        while True:
+            try:
+                index, pid, counters = self.metrics.get_nowait()
+            except queue.Empty:
+                return
+            self.latest[index] = (pid, counters)
+
+    def totals(self) -> Counter:
+        # Counters of dead processes are kept in `retired`, so totals never go backwards on a restart
+        totals = Counter(self.retired)
+        for _, counters in self.latest.values():
+            totals.update(counters)
+        return totals
+
+    def report(self):
+        per_process = ", ".join(f"{index}:{pid}={counters.get('files_copied', 0)}"
+                                for index, (pid, counters) in sorted(self.latest.items()))
+        totals = dict(sorted(self.totals().items()))
+        alive = sum(process.is_alive() for process in self.workers.values())
+        print(f"Workers {alive}/{self.processes}, restarts {self.restarts}, totals {totals}, files copied per worker [{per_process}]")
+
+    def check_workers(self):
+        now = time.monotonic()
+        for index, process in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            self.collect_metrics()
+            if index in self.latest:
+                self.retired.update(self.latest.pop(index)[1])
+            del self.workers[index]
+            if now - self.started_at[index] >= HEALTHY_RUN_SECONDS:
+                self.crashes[index] = 0
+            delay = min(RESTART_BACKOFF_SECONDS * 2 ** self.crashes[index], MAX_RESTART_BACKOFF_SECONDS)
+            self.crashes[index] += 1
+            self.restart_at[index] = now + delay
+            print(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting in {delay}s")
+        for index, restart_at in list(self.restart_at.items()):
+            if now >= restart_at:
+                del self.restart_at[index]
+                self.restarts += 1
+                self.start_worker(index)
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def drain(self):
+        # Workers get SIGTERM and drain on their own, whatever is still running after the drain timeout is killed
+        from file_backup3 import WORKER_DRAIN_TIMEOUT
+        print(f"Stopping {len(self.workers)} workers")
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + WORKER_DRAIN_TIMEOUT.total_seconds() + KILL_GRACE_SECONDS
+        for index, process in self.workers.items():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                print(f"Worker {index} (pid {process.pid}) did not drain in time, killing it")
+                process.kill()
+                process.join()
+        self.collect_metrics()
+        self.report()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        # Workers and their process pools inherit this and split the cores between them
+        os.environ["FILE_BACKUP_WORKER_PROCESSES"] = str(self.processes)
+        for index in range(self.processes):
+            self.start_worker(index)
+        next_report = time.monotonic() + self.metrics_interval
+        while not self.stopping:
+            time.sleep(0.5)
+            self.collect_metrics()
+            if self.stopping:
+                break
+            self.check_workers()
+            if time.monotonic() >= next_report:
+                self.report()
+                next_report += self.metrics_interval
+        self.drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several file backup worker processes on one task queue")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="worker processes to keep running")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL_SECONDS,
+                        help="seconds between metric summaries")
+    parser.add_argument("--pools", nargs="+", choices=("control", "scan", "copy", "verify"),
+                        help="worker pools each process runs, all of them by default")
+    parser.add_argument("--roots", nargs="+",
+                        help="local paths this host owns, their folders are only backed up by this host's workers")
+    args = parser.parse_args()
+    WorkerSupervisor(args.processes, args.metrics_interval, args.pools, args.roots).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import asyncio
+import os
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, Optional, Sequence
+
+from temporalio.worker import (
+    CustomSlotSupplier,
+    ResourceBasedSlotConfig,
+    ResourceBasedSlotSupplier,
+    ResourceBasedTunerConfig,
+    SlotMarkUsedContext,
+    SlotPermit,
+    SlotReleaseContext,
+    SlotReserveContext,
+    WorkerTuner,
+)
+
+
+# System CPU and memory usage the worker aims for before it stops taking on more tasks
+TARGET_CPU_USAGE = 0.8
+TARGET_MEMORY_USAGE = 0.8
+
+# Requests in flight on the busiest disk above which no more copy activities are admitted.
+# NVMe drives keep deep queues busy, a single spinning disk is saturated well before this.
+MAX_DISK_QUEUE_DEPTH = 32
+
+# Copy slots handed out regardless of load, the cap, and the pause between new slots so
+# the load of the last copy shows up before the next one is admitted
+MIN_COPY_SLOTS = 1
+MAX_COPY_SLOTS = 64
+COPY_SLOT_RAMP = timedelta(milliseconds=200)
+
+# How long /proc samples are reused before reading them again
+LOAD_SAMPLE_SECONDS = 0.1
+
+# Block devices that never hold backup data
+IGNORED_DEVICE_PREFIXES = ("loop", "ram", "zram", "sr", "dm-", "md")
+
+
+def disk_devices() -> Sequence[str]:
+    # Whole disks only, partitions are already counted in their disk's queue
+    try:
+        return [name for name in os.listdir("/sys/block") if not name.startswith(IGNORED_DEVICE_PREFIXES)]
+    except OSError:
+        return []
+
+
+def read_disk_queue_depths(devices: Sequence[str]) -> Dict[str, int]:
+    # The ninth stat field of /proc/diskstats is the number of I/Os currently in progress
+    depths = {}
+    try:
+        with open("/proc/diskstats") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 12 and fields[2] in devices:
+                    depths[fields[2]] = int(fields[11])
+    except OSError:
+        pass
+    return depths
+
+
+def read_cpu_times() -> Optional[tuple]:
+    # (busy, total) jiffies of all CPUs since boot
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(value) for value in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields)
+    return total - idle, total
+
+
+def read_memory_usage() -> Optional[float]:
+    meminfo = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0])
+    except (OSError, ValueError):
+        return None
+    if not meminfo.get("MemTotal") or "MemAvailable" not in meminfo:
+        return None
+    return 1 - meminfo["MemAvailable"] / meminfo["MemTotal"]
+
+
+class HostLoad:
+    # Samples CPU, memory and disk queue depth from /proc. On systems without /proc every
+    # reading is None and admission falls back to the slot limits alone.
+    def __init__(self, devices: Optional[Sequence[str]] = None, sample_seconds: float = LOAD_SAMPLE_SECONDS):
+        self.devices = list(devices) if devices else disk_devices()
+        self.sample_seconds = sample_seconds
+        self.sampled_at = None
+        self.cpu_times = read_cpu_times()
+        self.cpu_usage = None
+        self.memory_usage = None
+        self.queue_depth = None
+
+    def sample(self):
+        now = time.monotonic()
+        if self.sampled_at is not None and now - self.sampled_at < self.sample_seconds:
+            return
+        self.sampled_at = now
+        cpu_times = read_cpu_times()
+        if cpu_times and self.cpu_times and cpu_times[1] > self.cpu_times[1]:
+            self.cpu_usage = (cpu_times[0] - self.cpu_times[0]) / (cpu_times[1] - self.cpu_times[1])
+            self.cpu_times = cpu_times
+        elif cpu_times and not self.cpu_times:
+            self.cpu_times = cpu_times
+        self.memory_usage = read_memory_usage()
+        depths = read_disk_queue_depths(self.devices)
+        self.queue_depth = max(depths.values()) if depths else None
+
+
+class DiskAwareSlotSupplier(CustomSlotSupplier):
+    # Admits copy activities like the resource based supplier does (CPU and memory targets, a
+    # minimum, a maximum and a ramp between slots) and additionally holds them back while the
+    # busiest disk already has max_queue_depth requests in flight. Adding copies to a saturated
+    # disk only lengthens its queue, the files don't arrive any sooner.
+    # The SDK calls it from its own threads, and from several workers when they share the tuner,
+    # so the slot count and the load sample are only touched under the lock.
+    def __init__(self, target_cpu_usage: float = TARGET_CPU_USAGE, target_memory_usage: float = TARGET_MEMORY_USAGE,
+                 max_queue_depth: int = MAX_DISK_QUEUE_DEPTH, minimum_slots: int = MIN_COPY_SLOTS,
+                 maximum_slots: int = MAX_COPY_SLOTS, ramp_throttle: timedelta = COPY_SLOT_RAMP,
+                 devices: Optional[Sequence[str]] = None):
+        self.target_cpu_usage = target_cpu_usage
+        self.target_memory_usage = target_memory_usage
+        self.max_queue_depth = max_queue_depth
+        self.minimum_slots = minimum_slots
+        self.maximum_slots = maximum_slots
+        self.ramp_seconds = ramp_throttle.total_seconds()
+        self.load = HostLoad(devices)
+        self.issued = 0
+        self.last_issued_at = 0.0
+        self.lock = threading.Lock()
+
+    def admit(self) -> bool:
+        if self.issued < self.minimum_slots:
+            return True
+        if self.issued >= self.maximum_slots:
+            return False
+        if time.monotonic() - self.last_issued_at < self.ramp_seconds:
+            return False
+        self.load.sample()
+        if self.load.queue_depth is not None and self.load.queue_depth >= self.max_queue_depth:
+            return False
+        if self.load.cpu_usage is not None and self.load.cpu_usage > self.target_cpu_usage:
+            return False
+        if self.load.memory_usage is not None and self.load.memory_usage > self.target_memory_usage:
+            return False
+        return True
+
+    def try_issue(self) -> Optional[SlotPermit]:
+        with self.lock:
+            if not self.admit():
+                return None
+            self.issued += 1
+            self.last_issued_at = time.monotonic()
+            return SlotPermit()
+
+    async def reserve_slot(self, ctx: SlotReserveContext) -> SlotPermit:
+        while True:
+            permit = self.try_issue()
+            if permit:
+                return permit
+            await asyncio.sleep(self.load.sample_seconds)
+
+    def try_reserve_slot(self, ctx: SlotReserveContext) -> Optional[SlotPermit]:
+        return self.try_issue()
+
+    def mark_slot_used(self, ctx: SlotMarkUsedContext) -> None:
+        pass
+
+    def release_slot(self, ctx: SlotReleaseContext) -> None:
+        with self.lock:
+            self.issued -= 1
+
+
+def build_tuner(activity_slots: str = "disk", max_activity_slots: int = MAX_COPY_SLOTS,
+                target_cpu_usage: float = TARGET_CPU_USAGE, target_memory_usage: float = TARGET_MEMORY_USAGE,
+                max_disk_queue_depth: int = MAX_DISK_QUEUE_DEPTH) -> WorkerTuner:
+    # Workflow tasks and local activities (small scans and copy batches) are sized by the SDK's
+    # resource based supplier. Regular activities get the disk aware one with activity_slots "disk"
+    # (copies) and the resource based one with "resources" (scans, which are mostly stat calls).
+    # All resource based suppliers of a worker have to share one tuner config. A tuner takes the
+    # place of the max_concurrent_* worker options, max_activity_slots is the activity cap instead.
+    # Each worker gets its own tuner, so a pool's idle pollers never hold another pool's slots.
+    resources = ResourceBasedTunerConfig(target_memory_usage, target_cpu_usage)
+    if activity_slots == "disk":
+        activity_supplier = DiskAwareSlotSupplier(target_cpu_usage, target_memory_usage, max_disk_queue_depth,
+                                                  maximum_slots=max_activity_slots)
+    else:
+        activity_supplier = ResourceBasedSlotSupplier(ResourceBasedSlotConfig(minimum_slots=1, maximum_slots=max_activity_slots), resources)
+    return WorkerTuner.create_composite(
+        workflow_supplier=ResourceBasedSlotSupplier(ResourceBasedSlotConfig(minimum_slots=2), resources),
+        activity_supplier=activity_supplier,
+        local_activity_supplier=ResourceBasedSlotSupplier(ResourceBasedSlotConfig(minimum_slots=1), resources),
+    )